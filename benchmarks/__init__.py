@@ -0,0 +1 @@
+"""Benchmarks of the handicap calculation and page views against a synthetic database."""
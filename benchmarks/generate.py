@@ -0,0 +1,112 @@
+"""
+Generate a throwaway SQLite database of synthetic golfers for the benchmarks.
+
+    > <venv> python -m benchmarks.generate bench.db --users 1000 --rounds 200
+
+The same options and seed always generate the same golfers. The options are saved beside
+the database (bench.db.json), so the benchmark results can record what they were run against.
+"""
+import json
+import os
+import random
+import time
+from datetime import date, timedelta
+import click
+from sqlalchemy import insert
+from handicap import create_app, db, bcrypt
+from handicap.models import User, Score
+from handicap.recompute import recompute_all
+from benchmarks.harness import bench_config
+
+# Courses as (name, course rating, slope rating).
+COURSES = [('Newbattle Golf Club', 68.9, 129), ('Cathcart Castle', 69.5, 128),
+           ('Golf International de la Prèze', 72.4, 141), ('Golf Club de Mortemart', 72.3, 139),
+           ('Royal Burgess', 70.6, 127), ('Bruntsfield Links', 71.3, 131),
+           ('Gullane No. 1', 72.9, 136), ('Musselburgh Links', 65.1, 113)]
+
+def golfer_rounds(rng: random.Random, user_id: int, rounds: int, nine_hole_ratio: float, start: date, days: int):
+    """
+    Yield a golfer's rounds as Score rows, in played date order.
+
+    Each golfer has a true ability, and plays to it with some scatter. A share of the rounds
+    are two 9 hole rounds combined into one, as ScoringRecord.eighteenHoleRound() records them.
+    """
+    ability = rng.uniform(0, 36)
+    for day in sorted(rng.randrange(days + 1) for _ in range(rounds)):
+        course, rating, slope = rng.choice(COURSES)
+        expected = ability * slope / 113
+        if rng.random() < nine_hole_ratio:
+            front = round(rating / 2 + expected / 2 + rng.gauss(0.8, 2.5))
+            back = round(rating / 2 + expected / 2 + rng.gauss(0.8, 2.5))
+            gross_adjusted_score = front + back
+            course = f'Front 9: {course}, back 9: {course}.'
+        else:
+            gross_adjusted_score = round(rating + expected + rng.gauss(1.5, 3.5))
+        yield dict(played=start + timedelta(days=day), course_rating=rating, course_slope=slope,
+                   gross_adjusted_score=gross_adjusted_score, course=course, holes=18,
+                   score_differential=(gross_adjusted_score - rating) * 113 / slope, user_id=user_id)
+
+def generate(database: str, users: int=1000, rounds: int=200, nine_hole_ratio: float=0.1,
+             years: float=10, seed: int=1, chunk_size: int=50_000, workers: int=None) -> dict:
+    """
+    Create a benchmark database of synthetic golfers, with their index histories, replacing any at the path.
+
+    Parameters:
+    database (str): the path of the SQLite database.
+    users (int): the number of golfers.
+    rounds (int): the number of rounds each golfer has played.
+    nine_hole_ratio (float): the share of rounds made of two 9 hole rounds.
+    years (float): the span of the played dates, ending today.
+    seed (int): the random seed.
+    chunk_size (int): the number of rounds per bulk insert.
+    workers (int): the recompute worker processes (default: one per CPU).
+
+    Returns:
+    The options the database was generated with.
+    """
+    if os.path.exists(database):
+        os.remove(database)
+    os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    app = create_app(bench_config(database))
+    rng = random.Random(seed)
+    days = int(years * 365.25)
+    start = date.today() - timedelta(days=days)
+    with app.app_context():
+        password = bcrypt.generate_password_hash('benchmark').decode('utf-8')     # Hashing is slow, so all share one.
+        db.session.execute(insert(User.__table__),
+                           [dict(id=user_id, name=f'Golfer {user_id}', email=f'golfer{user_id}@example.com',
+                                 image_file='default.jpg', password=password, version=0)
+                            for user_id in range(1, users + 1)])
+        chunk = []
+        for user_id in range(1, users + 1):
+            chunk.extend(golfer_rounds(rng, user_id, rounds, nine_hole_ratio, start, days))
+            if len(chunk) >= chunk_size:
+                db.session.execute(insert(Score.__table__), chunk)
+                db.session.commit()
+                chunk = []
+        if chunk:
+            db.session.execute(insert(Score.__table__), chunk)
+        db.session.commit()
+        recompute_all(workers=workers)  # Fill in the handicaps and index histories from the rounds.
+    options = dict(users=users, rounds=rounds, nine_hole_ratio=nine_hole_ratio, years=years, seed=seed)
+    with open(database + '.json', 'w') as sidecar:
+        json.dump(options, sidecar)
+    return options
+
+@click.command()
+@click.argument('database', type=click.Path(dir_okay=False))
+@click.option('--users', type=click.IntRange(1, 10_000), default=1000, show_default=True, help='Golfers.')
+@click.option('--rounds', type=click.IntRange(1, 2_000), default=200, show_default=True, help='Rounds per golfer.')
+@click.option('--nine-hole-ratio', type=click.FloatRange(0, 1), default=0.1, show_default=True,
+              help='Share of rounds made of two 9 hole rounds.')
+@click.option('--years', type=click.FloatRange(min=0.1), default=10, show_default=True, help='Span of the played dates.')
+@click.option('--seed', type=int, default=1, show_default=True, help='Random seed.')
+@click.option('--workers', type=int, default=None, help='Recompute worker processes (default: one per CPU).')
+def main(database, users, rounds, nine_hole_ratio, years, seed, workers):
+    """Generate a benchmark DATABASE of synthetic golfers."""
+    start = time.perf_counter()
+    generate(database, users, rounds, nine_hole_ratio, years, seed, workers=workers)
+    click.echo(f'Generated {users} golfers with {rounds} rounds each in {time.perf_counter() - start:.1f}s.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import os
+import statistics
+import time
+import tracemalloc
+from sqlalchemy import event
+from handicap.config import Config
+
+def bench_config(database: str) -> type:
+    """Return a config class for an app on the benchmark database, with CSRF checks and mail sending off."""
+    class BenchConfig(Config):
+        SECRET_KEY = 'benchmark'
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath(database)
+        WTF_CSRF_ENABLED = False
+        MAIL_SUPPRESS_SEND = True
+    return BenchConfig
+
+class QueryCounter():
+    """Count the SQL statements an engine executes while it is switched on."""
+
+    def __init__(self, engine) -> None:
+        self.count = 0
+        self.counting = False
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def _before_cursor_execute(self, *args) -> None:
+        if self.counting:
+            self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        self.counting = True
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.counting = False
+
+def measure(function, queries: QueryCounter, repeat: int=20, setup=None) -> dict:
+    """
+    Time repeated calls of a function, then count the queries and peak memory of one more call.
+
+    Memory is traced in a call of its own, as tracing slows the code down too much to time it.
+
+    Parameters:
+    function: the code to measure, called with no arguments.
+    queries (QueryCounter): the counter on the app's engine.
+    repeat (int): the number of timed calls.
+    setup: called with no arguments before each call, outside the timing (e.g. to start a new session).
+
+    Returns:
+    A dict of the number of calls, median, mean and 95th percentile times in milliseconds,
+    queries per call and peak memory in KiB.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    if setup:
+        setup()
+    tracemalloc.start()
+    with queries:
+        function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarise(times, queries.count, peak / 1024)
+
+def summarise(times: list, queries: int=0, peak_kib: float=0.0) -> dict:
+    """Return the result of a benchmark from its times in milliseconds, as measure() does."""
+    times = sorted(times)
+    return dict(calls=len(times),
+                median_ms=round(statistics.median(times), 3),
+                mean_ms=round(statistics.fmean(times), 3),
+                p95_ms=round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+                queries=queries,
+                peak_kib=round(peak_kib, 1))
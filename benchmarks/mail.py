@@ -0,0 +1,94 @@
+"""
+Check and time the background mail queue against an SMTP stand-in run in this process.
+
+    > <venv> python -m benchmarks.mail bench.db [--messages 200 --drop 2]
+
+The stand-in drops its first --drop connections, so the retries are exercised, and the queue is also given
+messages that can't be sent at all (a header with a line break, a recipient that isn't ASCII), which must be
+logged and dropped without stopping a worker. The run fails unless every other message is delivered.
+"""
+import socketserver
+import sys
+import threading
+import time
+import click
+from handicap import create_app, mailer
+from benchmarks.harness import bench_config
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail: every command succeeds, and each message's data is kept."""
+    messages = []
+    connections = 0
+    drop = 0    # Connections still to drop before the greeting.
+    lock = threading.Lock()
+
+    def handle(self) -> None:
+        with self.lock:
+            SMTPStandIn.connections += 1
+            if SMTPStandIn.drop > 0:
+                SMTPStandIn.drop -= 1
+                return
+        self.reply('220 stand-in')
+        while line := self.rfile.readline():
+            command = line.decode('utf-8', 'replace').strip().upper()
+            if command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b'.\n', b''):
+                    data.append(line)
+                with self.lock:
+                    SMTPStandIn.messages.append(b''.join(data))
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text: str) -> None:
+        self.wfile.write((text + '\r\n').encode())
+
+@click.command()
+@click.argument('database', type=click.Path(exists=True, dir_okay=False))
+@click.option('--messages', type=click.IntRange(1), default=200, show_default=True, help='Messages to deliver.')
+@click.option('--drop', type=click.IntRange(0), default=2, show_default=True, help='Connections the stand-in drops first.')
+@click.option('--workers', type=click.IntRange(1), default=2, show_default=True, help='Mail worker threads.')
+def main(database, messages, drop, workers):
+    """Send mail through the queue of an app on DATABASE to an SMTP stand-in, and check it all arrives."""
+    from flask_mail import Message
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    SMTPStandIn.drop = drop
+
+    class MailConfig(bench_config(database)):
+        MAIL_SUPPRESS_SEND = False
+        MAIL_SERVER = '127.0.0.1'
+        MAIL_PORT = server.server_address[1]
+        MAIL_USE_TLS = False
+        MAIL_USERNAME = MAIL_PASSWORD = None
+        MAIL_WORKERS = workers
+        MAIL_QUEUE_SIZE = messages + 2
+        MAIL_RETRY_BACKOFF = 0.01
+    app = create_app(MailConfig)
+    start = time.perf_counter()
+    with app.app_context():
+        queued = [mailer.send(Message('Unsendable\nsubject', sender='club@example.com', recipients=['a@example.com'])),
+                  mailer.send(Message('Unsendable recipient', sender='club@example.com', recipients=['jürgen@exämple.com']))]
+        queued += [mailer.send(Message(f'Message {number}', sender='club@example.com', recipients=['a@example.com'],
+                                       body='Password reset')) for number in range(messages)]
+    while mailer._queue.qsize():    # The unsendable messages, first in the queue, have been taken.
+        time.sleep(0.01)
+    alive = all(thread.is_alive() for thread in mailer._threads)
+    mailer.shutdown()
+    seconds = time.perf_counter() - start
+    server.shutdown()
+
+    delivered = len(SMTPStandIn.messages)
+    click.echo(f'Queued {sum(queued)} of {len(queued)}, delivered {delivered} of {messages} over '
+               f'{SMTPStandIn.connections} connections in {seconds * 1000:.0f} ms; workers alive: {alive}.')
+    if not all(queued) or delivered != messages or not alive:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Run the benchmarks against a database made by benchmarks.generate, and save the results as a JSON baseline.
+
+    > <venv> python -m benchmarks.run bench.db [--compare benchmarks/baselines/<commit>.json]
+
+The results go to benchmarks/baselines/<commit>.json unless --output is given. With --compare, the
+median times are compared with an earlier baseline, and the run fails if any got slower than the threshold.
+addRound and posting a new score add rounds dated today to the sampled golfers' records.
+The start up is timed in new Python processes, by phase: importing the app, then create_app's phases.
+
+With --verify, nothing is timed: the sampled golfers' rounds are replayed through ScoringRecord.replayFrom,
+recompute_all is run (rewriting every golfer's handicaps), and the run fails if their results differ.
+"""
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+from datetime import date, datetime
+import click
+from sqlalchemy import func, select
+from handicap import create_app, db, fragments, snapshots, user_cache
+from handicap.models import User, Score, IndexHistory
+from handicap.handicap import ScoringRecord
+from handicap.recompute import recompute_all
+from benchmarks.harness import bench_config, measure, summarise, QueryCounter
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines')
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def new_round(player_id: int) -> Score:
+    """Return a round played today for a golfer, as the new score view would build it."""
+    return Score(played=date.today(), course_rating=70.6, course_slope=127, gross_adjusted_score=86,
+                 course='Royal Burgess', holes=18, score_differential=(86 - 70.6) * 113 / 127, user_id=player_id)
+
+# Run in a new process to time a cold start: prints the import time and create_app's phases, in seconds.
+COLD_START = '''
+import json, sys, time
+start = time.perf_counter()
+from handicap import create_app, metrics
+from benchmarks.harness import bench_config
+imported = time.perf_counter() - start
+create_app(bench_config(sys.argv[1]))
+print(json.dumps(dict(imports=imported, **metrics.boot_seconds)))
+'''
+
+def cold_start(database: str, repeat: int) -> dict:
+    """Time the app's start up in new processes, as a worker starting would, and return a result per phase."""
+    phases = {}
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', COLD_START, database], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+        for phase, seconds in json.loads(output.splitlines()[-1]).items():
+            phases.setdefault(phase, []).append(seconds * 1000)
+    phases['total'] = [sum(times) for times in zip(*phases.values())]
+    return {f'start {phase}': summarise(times) for phase, times in phases.items()}
+
+def run_benchmarks(app, players: list[int], repeat: int) -> dict:
+    """
+    Measure the scoring record methods and the page views for a sample of golfers.
+
+    Each call starts from a new session, as a request would. The views are measured both warm
+    (the snapshot, fragment and user caches filled by the previous call) and cold (the caches cleared).
+    """
+    results = {}
+    with app.app_context():
+        queries = QueryCounter(db.engine)
+        next_player = itertools.cycle(players).__next__
+
+        def record():
+            return ScoringRecord(next_player())
+
+        results['ScoringRecord()'] = measure(record, queries, repeat, setup=db.session.remove)
+        records = itertools.cycle([ScoringRecord(player) for player in players])
+        results['handicapIndex'] = measure(lambda: next(records).handicapIndex(), queries, repeat)
+        results['countingRounds'] = measure(lambda: next(records).countingRounds(), queries, repeat)
+        results['scorePage first'] = measure(lambda: record().scorePage(5, 1), queries, repeat, setup=db.session.remove)
+
+        def last_page():
+            player_record = record()
+            return player_record.scorePage(5, -(-player_record.window.rounds_played // 5))
+        results['scorePage last'] = measure(last_page, queries, repeat, setup=db.session.remove)
+
+        def add_round():
+            player = next_player()
+            return ScoringRecord(player).addRound(new_round(player))
+        results['addRound'] = measure(add_round, queries, repeat, setup=db.session.remove)
+        db.session.remove()
+
+    client = app.test_client()
+    next_player = itertools.cycle(players).__next__
+
+    def login():
+        with client.session_transaction() as session:
+            session['_user_id'] = str(next_player())
+            session['_fresh'] = True
+
+    def cold():
+        login()
+        snapshots.clear()
+        fragments.clear()
+        user_cache.clear()
+
+    def post_score():
+        response = client.post('/score/new', data=dict(course='Royal Burgess', played=date.today().isoformat(),
+                                                       strokes=86, rating=70.6, slope=127, holes=18))
+        assert response.status_code == 302, response.status_code
+
+    with app.app_context():
+        queries = QueryCounter(db.engine)
+    for name, url in [('home', '/home'), ('allscores', '/allscores'), ('new_score', '/score/new')]:
+        def view(url=url):
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+        for player in players:  # Fill the caches for the warm runs.
+            with client.session_transaction() as session:
+                session['_user_id'] = str(player)
+            client.get(url)
+        results[f'GET {name} warm'] = measure(view, queries, repeat, setup=login)
+        results[f'GET {name} cold'] = measure(view, queries, repeat, setup=cold)
+    results['POST new_score'] = measure(post_score, queries, repeat, setup=login)
+    return results
+
+def handicap_state(player_id: int) -> tuple:
+    """Return a golfer's handicap index, low handicap index and its date, and index history rows, in date order."""
+    user = db.session.execute(select(User.handicap_index, User.low_handicap_index, User.low_handicap_index_date)
+                              .where(User.id == player_id)).one()
+    history = db.session.execute(select(IndexHistory.handicap_index_date, IndexHistory.handicap_index,
+                                        IndexHistory.low_handicap_index, IndexHistory.low_handicap_index_date)
+                                 .where(IndexHistory.user_id == player_id)
+                                 .order_by(IndexHistory.handicap_index_date, IndexHistory.id)).all()
+    return tuple(user), [tuple(row) for row in history]
+
+def verify_recompute(app, players: list[int]) -> list[str]:
+    """
+    Check recompute_all against replaying each sampled golfer's rounds through ScoringRecord.replayFrom.
+    The replays are rolled back; recompute_all's results are committed, for every golfer.
+
+    Returns:
+    A description of each golfer's first difference, so an empty list if they agree.
+    """
+    with app.app_context():
+        replayed = {}
+        for player in players:
+            first = db.session.scalar(select(func.min(Score.played)).where(Score.user_id == player))
+            if first is not None:
+                ScoringRecord(player).replayFrom(first)
+            replayed[player] = handicap_state(player)
+        db.session.rollback()
+        recompute_all()
+        differences = []
+        for player in players:
+            (user, history), (expected_user, expected_history) = handicap_state(player), replayed[player]
+            if user != expected_user:
+                differences.append(f'Golfer {player}: (index, low index, low date) {user}, replayed {expected_user}')
+            elif history != expected_history:
+                row = next((number for number, (got, expected) in enumerate(zip(history, expected_history))
+                            if got != expected), min(len(history), len(expected_history)))
+                differences.append(f'Golfer {player}: history row {row} is '
+                                   f'{history[row] if row < len(history) else None}, replayed '
+                                   f'{expected_history[row] if row < len(expected_history) else None}')
+    return differences
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Print the results beside a baseline's, and return True if none got slower than the threshold."""
+    passed = True
+    click.echo(f'{"benchmark":<24}{"baseline ms":>14}{"now ms":>12}{"ratio":>8}{"queries":>10}')
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            click.echo(f'{name:<24}{"-":>14}{result["median_ms"]:>12.3f}')
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else 1
+        slower = ratio > threshold
+        passed = passed and not slower
+        click.echo(f'{name:<24}{before["median_ms"]:>14.3f}{result["median_ms"]:>12.3f}{ratio:>8.2f}'
+                   f'{before["queries"]:>5}->{result["queries"]:<4}{"  SLOWER" if slower else ""}')
+    return passed
+
+@click.command()
+@click.argument('database', type=click.Path(exists=True, dir_okay=False))
+@click.option('--players', type=click.IntRange(1), default=20, show_default=True, help='Golfers sampled.')
+@click.option('--repeat', type=click.IntRange(1), default=20, show_default=True, help='Timed calls per benchmark.')
+@click.option('--seed', type=int, default=1, show_default=True, help='Random seed for the sample.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Where to save the results (default: benchmarks/baselines/<commit>.json).')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='An earlier baseline to compare with.')
+@click.option('--threshold', type=float, default=1.2, show_default=True,
+              help='The slowdown (now / baseline) counted as a regression.')
+@click.option('--verify', is_flag=True, help='Check recompute_all against ScoringRecord.replayFrom instead.')
+def main(database, players, repeat, seed, output, baseline_path, threshold, verify):
+    """Benchmark the handicap calculation and page views against DATABASE."""
+    app = create_app(bench_config(database))
+    with app.app_context():
+        player_ids = db.session.scalars(db.select(User.id).order_by(User.id)).all()
+    sample = random.Random(seed).sample(player_ids, min(players, len(player_ids)))
+    if verify:
+        differences = verify_recompute(app, sample)
+        for difference in differences:
+            click.echo(difference)
+        click.echo(f'recompute_all and replayFrom differ for {len(differences)} of {len(sample)} golfers.')
+        sys.exit(1 if differences else 0)
+    results = cold_start(database, min(repeat, 10))
+    results.update(run_benchmarks(app, sample, repeat))
+
+    dataset = None
+    if os.path.exists(database + '.json'):
+        with open(database + '.json') as sidecar:
+            dataset = json.load(sidecar)
+    commit = git_commit()
+    report = dict(commit=commit, created=datetime.now().isoformat(timespec='seconds'),
+                  python=platform.python_version(), dataset=dataset,
+                  players=len(sample), repeat=repeat, results=results)
+    output = output or os.path.join(BASELINES, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as baseline_file:
+        json.dump(report, baseline_file, indent=2)
+
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            passed = compare(results, json.load(baseline_file), threshold)
+        if not passed:
+            sys.exit(1)
+    else:
+        for name, result in results.items():
+            click.echo(f'{name:<24}{result["median_ms"]:>10.3f} ms{result["queries"]:>5} queries'
+                       f'{result["peak_kib"]:>10.1f} KiB')
+    click.echo(f'Saved {output}')
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
+import os
+from time import perf_counter
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from flask_mail import Mail
 from handicap.config import Config
+from handicap.snapshots import SnapshotCache
+from handicap.usercache import UserCache
+from handicap.metrics import Metrics
+from handicap.mailer import MailQueue
+from handicap.leaderboard import Leaderboards
+from handicap.caching import Compression
+from handicap.fragments import FragmentCache
+from handicap.assets import StaticAssets
   
 # Needed to create a db.
 class Base(DeclarativeBase):
@@ -19,30 +28,70 @@ login_manager = LoginManager()
 login_manager.login_view = 'users.login'        # The html template displayed when the login_required requires login.
 login_manager.login_message_category = 'info'   # Blue backround on the alert message.
 
-mail = Mail()
+mailer = MailQueue()    # Sends mail in the background, with Flask-Mail loaded on first use.
 
-def create_app(config_class=Config):
-    """Create a Flask application."""
+snapshots = SnapshotCache()     # Per-player handicap snapshots served to page views.
+user_cache = UserCache()        # Logged in users, loaded without a query on page views.
+metrics = Metrics()             # Request, SQL and handicap calculation metrics, served on /metrics.
+leaderboards = Leaderboards()   # Live event leaderboards, streamed to watchers.
+compression = Compression()     # Gzip for HTML and JSON responses.
+fragments = FragmentCache()     # Per-player rendered template fragments, and compiled templates on disk.
+assets = StaticAssets()         # Fingerprinted, precompressed static files.
+
+def create_app(config_class=None):
+    """Create a Flask application, with the config class given, or named by HANDICAP_CONFIG, or Config."""
+    boot = [('start', perf_counter())]  # The end of each start up phase, timed so regressions show on /metrics.
     # Create the app.
     app = Flask(__name__)
-    app.config.from_object(config_class)  # Load the config from the config.py file.
+    app.config.from_object(config_class or os.environ.get('HANDICAP_CONFIG') or Config)  # Load the config from the config.py file.
 
     db.init_app(app)  # Initialise the database with the app.
     bcrypt.init_app(app)    # Initialise the bcrypt with the app.
     login_manager.init_app(app)  # Initialise the login manager with the app.
-    mail.init_app(app)  # Initialise the mail with the app.
+    mailer.init_app(app)    # Initialise the background mail queue with the app.
+    snapshots.init_app(app)  # Initialise the handicap snapshot cache with the app.
+    user_cache.init_app(app)  # Initialise the user cache with the app.
+    metrics.init_app(app)   # Instrument the requests and the database engine.
+    leaderboards.init_app(app)  # Initialise the live leaderboards with the app.
+    compression.init_app(app)   # Compress the responses of the app.
+    fragments.init_app(app)     # Initialise the template caches with the app.
+    assets.init_app(app)        # Fingerprint and precompress the static files.
+    boot.append(('extensions', perf_counter()))
 
     # Register the blueprints.
     from handicap.users.routes import users
     from handicap.scores.routes import scores
     from handicap.main.routes import main
     from handicap.errors.handlers import errors
+    from handicap.api.routes import api
+    from handicap.competitions.routes import competitions
     app.register_blueprint(users)
     app.register_blueprint(scores)
     app.register_blueprint(main)
     app.register_blueprint(errors)  # Register the errors blueprint.
+    app.register_blueprint(api)     # The JSON API, under /api/v1.
+    app.register_blueprint(competitions)
+
+    # Register the command line commands.
+    from handicap.commands import recompute_handicaps, import_scores_command, db_maintenance, course_handicaps_command, apply_pcc, api_token
+    app.cli.add_command(recompute_handicaps)
+    app.cli.add_command(api_token)
+    app.cli.add_command(apply_pcc)
+    app.cli.add_command(import_scores_command)
+    app.cli.add_command(db_maintenance)
+    app.cli.add_command(course_handicaps_command)
+    boot.append(('blueprints', perf_counter()))
 
+    from handicap.schema import ensure_schema
+    from handicap.sqlite import configure_sqlite
     with app.app_context():
-        db.create_all()
+        if db.engine.dialect.name == 'sqlite':
+            configure_sqlite(db.engine, app.config['SQLITE_PRAGMAS'], app.config['SQLITE_IMMEDIATE_WRITES'])
+        ensure_schema(app.config['SCHEMA_CHECK'])     # Create or upgrade the schema if the models have changed.
+        db.engine.dispose()     # Leave no pooled connections to be shared by forked worker processes.
+    boot.append(('schema', perf_counter()))
 
+    boot_seconds = {phase: end - begin for (_, begin), (phase, end) in zip(boot, boot[1:])}
+    metrics.record_boot(boot_seconds)
+    app.logger.info('Started in ' + ', '.join(f'{phase} {seconds * 1000:.1f} ms' for phase, seconds in boot_seconds.items()))
     return app
\ No newline at end of file
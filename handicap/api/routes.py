@@ -0,0 +1,264 @@
+from datetime import date
+from flask import Blueprint, Response, abort, current_app, g, jsonify, request
+from flask_login import current_user
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import select, tuple_
+from handicap import db
+from handicap.models import User, Score, IndexHistory
+from handicap.handicap import SCORE_VIEW_COLUMNS, ScoreView, player_records, score_views
+from handicap.history import YEAR, index_on, lowest_between
+from handicap.competition import field_handicaps, parse_tees, to_csv
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MAX_FIELD_SIZE = 500    # Players looked up in one request.
+MAX_BATCH_SIZE = 2000   # Players whose handicap records are returned by one request.
+PAGE_LIMIT = 100        # Rows on a page of a player's rounds or index history, unless ?limit= asks for up to MAX_PAGE_LIMIT.
+MAX_PAGE_LIMIT = 1000
+# The columns of the rows of rounds and index history, named once per response rather than in every row.
+ROUND_FIELDS = ['id', 'played', 'course', 'course_rating', 'course_slope', 'gross_adjusted_score', 'score_differential', 'pcc']
+COUNTING_ROUND_FIELDS = ['recency'] + ROUND_FIELDS
+HISTORY_FIELDS = ['id', 'date', 'handicap_index', 'low_handicap_index', 'low_handicap_index_date']
+
+@api.before_request
+def require_login():
+    """
+    Let in logged in users, and machine clients with an API token (see load_api_client).
+    Only club tokens read other players' data: players, and their own tokens, read their own (see readable).
+    """
+    if not current_user.is_authenticated:
+        abort(401)
+
+def readable(player_ids: list[int]) -> list[int]:
+    """Return the player ids, if the client may read all of their data: a club token reads anyone's, others only their own."""
+    if not g.get('club_client') and any(player_id != current_user.id for player_id in player_ids):
+        abort(403, 'Only your own data can be read, without a club API token.')
+    return player_ids
+
+def json_error(error):
+    """Answer errors in the API as JSON, rather than with the site's error pages."""
+    response = jsonify(error=error.name, message=error.description)
+    if error.code == 401:
+        response.headers['WWW-Authenticate'] = 'Bearer'
+    return response, error.code
+
+# By code, as the site's handlers for these codes would otherwise be found first.
+for code in (400, 401, 403, 404, 405, 500):
+    api.register_error_handler(code, json_error)
+
+def date_arg(name: str, default: date=None) -> date:
+    """Return a date query parameter (YYYY-MM-DD), or the default if it is missing."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400, f'{name} must be a date as YYYY-MM-DD.')
+
+def players_arg(most: int=MAX_FIELD_SIZE) -> list[int]:
+    """Return the player ids of the players query parameter, a comma separated list."""
+    try:
+        player_ids = [int(player_id) for player_id in request.args.get('players', '').split(',') if player_id.strip()]
+    except ValueError:
+        abort(400, 'players must be a comma separated list of player ids.')
+    return checked_field(player_ids, most)
+
+def players_body(most: int=MAX_FIELD_SIZE) -> list[int]:
+    """Return the player ids of a JSON object's players list."""
+    body = request.get_json(silent=True)
+    players = body.get('players') if isinstance(body, dict) else None
+    if not isinstance(players, list) or not all(isinstance(player_id, int) for player_id in players):
+        abort(400, 'players must be a list of player ids.')
+    return checked_field(players, most)
+
+def checked_field(player_ids: list[int], most: int=MAX_FIELD_SIZE) -> list[int]:
+    """Return a field's player ids, if there are some and not too many."""
+    if not player_ids:
+        abort(400, 'players is required.')
+    if len(player_ids) > most:
+        abort(400, f'At most {most} players can be looked up at once.')
+    return readable(player_ids)
+
+def range_args() -> tuple[date, date]:
+    """Return the start and end query parameters, by default the year (52 weeks) up to today."""
+    end = date_arg('end', date.today())
+    start = date_arg('start', end - YEAR)
+    if start > end:
+        abort(400, 'start must not be after end.')
+    return start, end
+
+def index_entry(player_id: int, handicap_index: float | None) -> dict:
+    return dict(player_id=player_id, handicap_index=round(handicap_index, 1) if handicap_index is not None else None)
+
+def low_entry(player_id: int, lowest: tuple | None) -> dict:
+    low_date, low_index = lowest if lowest else (None, None)
+    return dict(player_id=player_id, low_handicap_index=round(low_index, 1) if low_index is not None else None,
+                low_handicap_index_date=low_date.isoformat() if low_date else None)
+
+@api.route('/players/<int:player_id>/index')
+def player_index(player_id):
+    """A player's handicap index as of a date (?date=YYYY-MM-DD, by default today)."""
+    day = date_arg('date', date.today())
+    indexes = index_on(readable([player_id]), day)
+    if player_id not in indexes:
+        abort(404, 'There is no such player.')
+    return jsonify(date=day.isoformat(), **index_entry(player_id, indexes[player_id]))
+
+@api.route('/players/<int:player_id>/low-index')
+def player_low_index(player_id):
+    """A player's lowest handicap index between two dates (?start=&end=, by default the year up to today)."""
+    start, end = range_args()
+    lows = lowest_between(readable([player_id]), start, end)
+    if player_id not in lows:
+        abort(404, 'There is no such player.')
+    return jsonify(start=start.isoformat(), end=end.isoformat(), **low_entry(player_id, lows[player_id]))
+
+@api.route('/indexes')
+def field_indexes():
+    """The handicap indexes of a field of players as of a date (?players=1,2,3&date=YYYY-MM-DD)."""
+    player_ids = players_arg()
+    day = date_arg('date', date.today())
+    indexes = index_on(player_ids, day)
+    return jsonify(date=day.isoformat(),
+                   players=[index_entry(player_id, indexes[player_id]) for player_id in player_ids if player_id in indexes],
+                   unknown=[player_id for player_id in player_ids if player_id not in indexes])
+
+@api.route('/low-indexes')
+def field_low_indexes():
+    """The lowest handicap indexes of a field of players between two dates (?players=1,2,3&start=&end=)."""
+    player_ids = players_arg()
+    start, end = range_args()
+    lows = lowest_between(player_ids, start, end)
+    return jsonify(start=start.isoformat(), end=end.isoformat(),
+                   players=[low_entry(player_id, lows[player_id]) for player_id in player_ids if player_id in lows],
+                   unknown=[player_id for player_id in player_ids if player_id not in lows])
+
+@api.route('/course-handicaps', methods=['POST'])
+def field_course_handicaps():
+    """
+    The course and playing handicaps, and strokes by hole, of a field on a set of tees.
+    Takes a JSON object of players (a list of ids), tees (a list of objects with name, course_rating,
+    course_slope, par, and optionally holes and stroke_index), allowance (by default 1) and date
+    (to take the indexes on, by default the current ones). Returns JSON, or CSV with ?format=csv.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, 'The request must be a JSON object.')
+    players = players_body()
+    try:
+        tees = parse_tees(body.get('tees'))
+    except ValueError as error:
+        abort(400, str(error))
+    try:
+        allowance = float(body.get('allowance', 1.0))
+    except (TypeError, ValueError):
+        abort(400, 'allowance must be a number.')
+    try:
+        day = date.fromisoformat(body['date']) if body.get('date') else None
+    except (TypeError, ValueError):
+        abort(400, 'date must be a date as YYYY-MM-DD.')
+    if not 0 < allowance <= 1:
+        abort(400, 'allowance must be more than 0 and no more than 1.')
+    result = field_handicaps(players, tees, allowance, day)
+    if request.args.get('format') == 'csv':
+        return Response(to_csv(result), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=course-handicaps.csv'})
+    return jsonify(result)
+
+def decimal(value: float | None) -> float | None:
+    return round(value, 1) if value is not None else None
+
+def iso(day: date | None) -> str | None:
+    return day.isoformat() if day else None
+
+def round_row(score: ScoreView) -> list:
+    return [score.id, iso(score.played), score.course, score.course_rating, score.course_slope,
+            score.gross_adjusted_score, decimal(score.score_differential), score.pcc]
+
+@api.route('/handicaps', methods=['GET', 'POST'])
+def handicap_records():
+    """
+    The handicap index, low handicap index and counting rounds of up to 2,000 players, read with one query.
+    Takes ?players=1,2,3, or for long lists a POST of a JSON object with players (a list of ids).
+    The counting rounds are rows of the columns listed once in counting_round_fields, recency being
+    the round's place among the most recent rounds (1 the most recent).
+    """
+    player_ids = players_body(MAX_BATCH_SIZE) if request.method == 'POST' else players_arg(MAX_BATCH_SIZE)
+    records = player_records(player_ids)
+    return jsonify(counting_round_fields=COUNTING_ROUND_FIELDS,
+                   players=[dict(player_id=record.id, name=record.name,
+                                 handicap_index=decimal(record.handicap_index),
+                                 low_handicap_index=decimal(record.low_handicap_index),
+                                 low_handicap_index_date=iso(record.low_handicap_index_date),
+                                 rounds_played=record.rounds_played,
+                                 counting_rounds=[[recency] + round_row(score) for recency, score, _ in record.counting_rounds])
+                            for record in (records[player_id] for player_id in dict.fromkeys(player_ids) if player_id in records)],
+                   unknown=[player_id for player_id in dict.fromkeys(player_ids) if player_id not in records])
+
+def cursor_serialiser() -> URLSafeSerializer:
+    """Return the serialiser that signs page cursors, so they can't be edited to seek elsewhere."""
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='api-cursor')
+
+def page_args(kind: str, player_id: int) -> tuple[int, tuple[date, int] | None]:
+    """
+    Return the limit and the (date, id) key to continue after of a page of a player's rows,
+    from the limit and cursor query parameters. A cursor is only good for the list it came from.
+    """
+    limit = request.args.get('limit', PAGE_LIMIT, type=int)
+    if not 1 <= limit <= MAX_PAGE_LIMIT:
+        abort(400, f'limit must be from 1 to {MAX_PAGE_LIMIT}.')
+    token = request.args.get('cursor')
+    if not token:
+        return limit, None
+    try:
+        cursor_kind, cursor_player, ordinal, row_id = cursor_serialiser().loads(token)
+        key = (date.fromordinal(ordinal), int(row_id))
+    except (BadSignature, ValueError, TypeError, OverflowError):
+        abort(400, 'cursor is not valid.')
+    if (cursor_kind, cursor_player) != (kind, player_id):
+        abort(400, 'cursor is not valid.')
+    return limit, key
+
+def next_cursor(kind: str, player_id: int, rows: list, limit: int, key) -> str | None:
+    """Return the cursor of the page after rows, fetched one over the limit, or None if there are no more."""
+    if len(rows) <= limit:
+        return None
+    day, row_id = key(rows[limit - 1])
+    return cursor_serialiser().dumps([kind, player_id, day.toordinal(), row_id])
+
+def existing_player(player_id: int) -> int:
+    readable([player_id])   # Before looking, so others' ids can't be probed.
+    if db.session.scalar(select(User.id).where(User.id == player_id)) is None:
+        abort(404, 'There is no such player.')
+    return player_id
+
+@api.route('/players/<int:player_id>/scores')
+def player_scores(player_id):
+    """
+    A player's rounds, most recently played first, a page at a time (?limit=, by default 100).
+    Each page gives the cursor of the next (?cursor=), which seeks to it by (played, id), however deep it is.
+    """
+    limit, after = page_args('scores', existing_player(player_id))
+    query = select(*SCORE_VIEW_COLUMNS).where(Score.user_id == player_id)
+    if after:
+        query = query.where(tuple_(Score.played, Score.id) < after)
+    scores = score_views(query.order_by(Score.played.desc(), Score.id.desc()).limit(limit + 1))
+    return jsonify(player_id=player_id, fields=ROUND_FIELDS, scores=[round_row(score) for score in scores[:limit]],
+                   next=next_cursor('scores', player_id, scores, limit, lambda score: (score.played, score.id)))
+
+@api.route('/players/<int:player_id>/history')
+def player_history(player_id):
+    """A player's handicap index history, most recent first, a page at a time (?limit=&cursor=, as for scores)."""
+    limit, after = page_args('history', existing_player(player_id))
+    query = select(IndexHistory.id, IndexHistory.handicap_index_date, IndexHistory.handicap_index,
+                   IndexHistory.low_handicap_index, IndexHistory.low_handicap_index_date) \
+                .where(IndexHistory.user_id == player_id)
+    if after:
+        query = query.where(tuple_(IndexHistory.handicap_index_date, IndexHistory.id) < after)
+    rows = db.session.execute(query.order_by(IndexHistory.handicap_index_date.desc(), IndexHistory.id.desc())
+                              .limit(limit + 1)).all()
+    return jsonify(player_id=player_id, fields=HISTORY_FIELDS,
+                   history=[[row_id, iso(day), decimal(handicap_index), decimal(low), iso(low_date)]
+                            for row_id, day, handicap_index, low, low_date in rows[:limit]],
+                   next=next_cursor('history', player_id, rows, limit, lambda row: (row[1], row[0])))
@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from threading import Lock
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+YEAR = 365 * 24 * 60 * 60
+FINGERPRINTED = re.compile(r'^(.*)\.([0-9a-f]{12})(\.[^./]+)$')    # name.<content hash>.ext
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))    # Precompressed variants, in order of preference.
+
+class StaticAssets():
+    """
+    Serve the static files under fingerprinted names, e.g. main.3f2a9c01d4e5.css, taken from a hash of
+    their contents, so browsers can cache them for good: url_for('static', ...) gives the fingerprinted
+    name, and a changed file gets a new name. Text files (STATIC_COMPRESS_EXTENSIONS) are precompressed
+    with gzip and, if the Brotli package is installed, brotli at start up, into STATIC_BUILD_FOLDER
+    (by default in the instance folder), and sent precompressed to clients that accept it.
+
+    Files are fingerprinted when first linked, so pictures added while the app runs are too. A request
+    for a stale fingerprint, e.g. from a page rendered before a deploy, is sent the current file
+    with Flask's default caching.
+    """
+
+    def __init__(self, app=None) -> None:
+        self.build_folder = None
+        self.compress_extensions = {'.css', '.js', '.svg', '.txt', '.json', '.map'}
+        self._names = {}    # File name: fingerprinted name.
+        self._remember = True   # False in debug mode, where files are edited while the app runs.
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        if not app.config.get('STATIC_FINGERPRINT', True):
+            return
+        self.build_folder = app.config.get('STATIC_BUILD_FOLDER') or os.path.join(app.instance_path, 'static_build')
+        self.compress_extensions = set(app.config.get('STATIC_COMPRESS_EXTENSIONS', self.compress_extensions))
+        self._remember = not app.debug
+        with self._lock:
+            self._names.clear()
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self.send_static_file
+        self.build(app.static_folder)
+
+    def build(self, static_folder: str) -> int:
+        """
+        Fingerprint and precompress the text files in the static folder, skipping those already built.
+
+        Returns:
+        The number of files compressed.
+        """
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        os.makedirs(self.build_folder, exist_ok=True)
+        built = 0
+        for root, directories, files in os.walk(static_folder):
+            for name in files:
+                if os.path.splitext(name)[1] not in self.compress_extensions:
+                    continue
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+                fingerprinted = self.fingerprint(filename, static_folder)
+                with open(path, 'rb') as source:
+                    data = source.read()
+                for encoding, suffix in ENCODINGS:
+                    target = os.path.join(self.build_folder, *(fingerprinted + suffix).split('/'))
+                    if os.path.exists(target) or (encoding == 'br' and brotli is None):
+                        continue
+                    compressed = brotli.compress(data, quality=11) if encoding == 'br' else gzip.compress(data, 9, mtime=0)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    # Written under a temporary name, so another worker starting up never sends a partial file.
+                    temporary = f'{target}.{os.getpid()}.tmp'
+                    with open(temporary, 'wb') as output:
+                        output.write(compressed)
+                    os.replace(temporary, target)
+                    built += 1
+        return built
+
+    def fingerprint(self, filename: str, static_folder: str=None) -> str:
+        """
+        Return the fingerprinted name of a static file, or the name unchanged if there is no such file.
+
+        Parameters:
+        filename (str): the file's path in the static folder, e.g. 'main.css'.
+        static_folder (str): the static folder, by default the app's.
+        """
+        with self._lock:
+            fingerprinted = self._names.get(filename)
+        if fingerprinted is None:
+            path = safe_join(static_folder or current_app.static_folder, filename)
+            if path is None:    # Outside the static folder.
+                return filename
+            try:
+                with open(path, 'rb') as source:
+                    digest = hashlib.sha256(source.read()).hexdigest()[:12]
+            except OSError:     # A missing file (or a directory) is linked as it is.
+                return filename
+            stem, extension = os.path.splitext(filename)
+            fingerprinted = f'{stem}.{digest}{extension}'
+            if self._remember:
+                with self._lock:
+                    self._names[filename] = fingerprinted
+        return fingerprinted
+
+    def _url_defaults(self, endpoint: str, values: dict) -> None:
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.fingerprint(values['filename'])
+
+    def send_static_file(self, filename: str):
+        """The static view: a fingerprinted file is sent, precompressed if it can be, with immutable far-future caching."""
+        match = FINGERPRINTED.match(filename)
+        original = match.group(1) + match.group(3) if match else None
+        if original is None:
+            return current_app.send_static_file(filename)
+        if self.fingerprint(original) != filename:
+            return current_app.send_static_file(original)   # A stale fingerprint: the current file, revalidated as usual.
+        mimetype = mimetypes.guess_type(original)[0] or 'application/octet-stream'
+        response = None
+        if os.path.splitext(original)[1] in self.compress_extensions:
+            for encoding, suffix in ENCODINGS:
+                if request.accept_encodings[encoding] and os.path.exists(os.path.join(self.build_folder, *(filename + suffix).split('/'))):
+                    response = send_from_directory(self.build_folder, filename + suffix, mimetype=mimetype, max_age=YEAR)
+                    response.headers['Content-Encoding'] = encoding
+                    break
+        if response is None:
+            response = send_from_directory(current_app.static_folder, original, mimetype=mimetype, max_age=YEAR)
+        if os.path.splitext(original)[1] in self.compress_extensions:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+import os
+from functools import wraps
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+_releases = {}  # Template folder: a hash of its templates and the static files they link.
+RELEASE_STATIC_EXTENSIONS = {'.css', '.js', '.svg'}    # Static files whose fingerprinted names are in the pages.
+
+def release() -> str:
+    """
+    Return a short hash of the app's templates and static style sheets and scripts, so pages cached by
+    browsers are refreshed when they change, and link the new fingerprinted names of changed files.
+    It is the same in every worker process, as it is taken from the files' contents.
+    """
+    folder = os.path.join(current_app.root_path, current_app.template_folder)
+    if folder not in _releases:
+        digest = hashlib.sha256()
+        for top, extensions in ((folder, None), (current_app.static_folder, RELEASE_STATIC_EXTENSIONS)):
+            for root, directories, files in os.walk(top):
+                directories.sort()
+                for name in sorted(files):
+                    if extensions is None or os.path.splitext(name)[1] in extensions:
+                        with open(os.path.join(root, name), 'rb') as source:
+                            digest.update(name.encode() + source.read())
+        _releases[folder] = digest.hexdigest()[:12]
+    return _releases[folder]
+
+def player_etag(user) -> str:
+    """Return the entity tag of the pages of a player's data: it changes with every write that bumps the player's version."""
+    return f'{user.id}-{user.version}-{release()}'
+
+def conditional_response(render):
+    """
+    Return the response of a page that depends only on the logged in player's data (and its URL), calling render()
+    for it only if the browser's If-None-Match doesn't show it already has the page for the player's current version,
+    when it is answered with 304 Not Modified. Call it once the player is known to be allowed the page.
+
+    Only GET and HEAD requests are answered this way. Pages are sent with a weak ETag of the player's version (weak, as they are the same page compressed or not)
+    and Cache-Control: private, no-cache, so browsers keep them but check each time. Pages with a message
+    flashed for them, and pages for anonymous visitors, are rendered as usual.
+    """
+    if request.method not in ('GET', 'HEAD') or not current_user.is_authenticated or session.get('_flashes'):
+        return render()
+    etag = player_etag(current_user)
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+def conditional(view):
+    """
+    Decorate a page view that shows only the logged in player's own data, and needs no other checks,
+    to be answered by conditional_response() before the view does any work.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return conditional_response(lambda: view(*args, **kwargs))
+    return wrapper
+
+class Compression():
+    """
+    Compress responses with gzip for clients that accept it: HTML pages and JSON, of COMPRESS_MIN_SIZE bytes or more.
+    Streamed responses (e.g. event streams) and files sent straight from disk are left alone.
+    """
+
+    def __init__(self, app=None) -> None:
+        self.level = 6
+        self.min_size = 500
+        self.mimetypes = {'text/html', 'application/json', 'text/csv'}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.level = app.config.get('COMPRESS_LEVEL', self.level)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        app.after_request(self._after_request)
+
+    def _after_request(self, response):
+        if response.mimetype not in self.mimetypes:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+                or 'Content-Encoding' in response.headers or not request.accept_encodings['gzip']:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        response.set_data(gzip.compress(data, self.level))
+        response.headers['Content-Encoding'] = 'gzip'
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag + '-gzip')   # A strong tag names the exact bytes.
+        return response
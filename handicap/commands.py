@@ -0,0 +1,123 @@
+import time
+import click
+from flask.cli import with_appcontext
+
+@click.command('recompute-handicaps')
+@click.option('--workers', type=int, default=None, help='Worker processes (default: one per CPU).')
+@click.option('--batch-size', type=int, default=200, show_default=True, help='Players sent to a worker at a time.')
+@with_appcontext
+def recompute_handicaps(workers, batch_size):
+    """Recompute every player's handicap index and index history from their rounds."""
+    from handicap.recompute import recompute_all
+    start = time.perf_counter()
+    players = recompute_all(workers=workers, batch_size=batch_size)
+    click.echo(f'Recomputed {players} players in {time.perf_counter() - start:.1f}s.')
+
+@click.command('import-scores')
+@click.argument('email')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='The file format (default: from the file extension).')
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Rounds inserted per statement.')
+@with_appcontext
+def import_scores_command(email, path, file_format, chunk_size):
+    """Import a CSV or JSON Lines file of rounds into the scoring record of the player with EMAIL."""
+    from sqlalchemy.orm.exc import StaleDataError
+    from handicap import db
+    from handicap.models import User
+    from handicap.scores.utils import import_scores
+    user = User.query.filter_by(email=email.lower()).first()
+    if user is None:
+        raise click.BadParameter(f'No player is registered with {email}.', param_hint='EMAIL')
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    start = time.perf_counter()
+    with open(path, newline='', encoding='utf-8-sig') as stream:
+        try:
+            imported, errors = import_scores(user.id, stream, file_format, chunk_size=chunk_size)
+        except StaleDataError:
+            db.session.rollback()
+            raise click.ClickException('The player\'s record changed while importing; nothing was written, run it again.')
+    for error in errors:
+        click.echo(error, err=True)
+    click.echo(f'Imported {imported} rounds for {user.email} in one transaction, holding the write lock {time.perf_counter() - start:.1f}s.')
+
+@click.command('api-token')
+@click.argument('email')
+@click.option('--name', required=True, help='What the token is for, e.g. tee-sheet.')
+@click.option('--club', is_flag=True, help='Let the token read every player\'s data, not only the player\'s own.')
+@click.option('--revoke', is_flag=True, help='Revoke the player\'s tokens with this name instead.')
+@with_appcontext
+def api_token(email, name, club, revoke):
+    """Issue a JSON API token to the player with EMAIL, for a machine client to send as 'Authorization: Bearer <token>'."""
+    from handicap import db
+    from handicap.models import User, ApiToken
+    user = User.query.filter_by(email=email.lower()).first()
+    if user is None:
+        raise click.BadParameter(f'No player is registered with {email}.', param_hint='EMAIL')
+    if revoke:
+        revoked = ApiToken.query.filter_by(user_id=user.id, name=name).delete()
+        db.session.commit()
+        click.echo(f'Revoked {revoked} tokens.')
+        return
+    token = ApiToken.issue(user, name, club)
+    db.session.commit()
+    click.echo(token)
+
+@click.command('apply-pcc')
+@click.option('--through', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='The last day to adjust (default: yesterday).')
+@click.option('--rebuild', is_flag=True, help='First total the rounds of every day, e.g. those posted before totals were kept.')
+@with_appcontext
+def apply_pcc(through, rebuild):
+    """Apply the playing conditions adjustment to the days whose rounds have changed. Run it nightly, e.g. from cron."""
+    from sqlalchemy.orm.exc import StaleDataError
+    from handicap import db
+    from handicap.conditions import apply_playing_conditions, rebuild_conditions
+    start = time.perf_counter()
+    if rebuild:
+        click.echo(f'Totalled the rounds of {rebuild_conditions()} days.')
+    try:
+        days, players = apply_playing_conditions(through.date() if through else None)
+    except StaleDataError:
+        db.session.rollback()
+        raise click.ClickException('A player\'s record changed while adjusting; nothing was written, run it again.')
+    click.echo(f'Adjusted {days} days, replaying {players} players, in {time.perf_counter() - start:.1f}s.')
+
+@click.command('db-maintenance')
+@click.option('--checkpoint', type=click.Choice(['PASSIVE', 'FULL', 'RESTART', 'TRUNCATE']), default='TRUNCATE',
+              show_default=True, help='The write-ahead log checkpoint mode.')
+@click.option('--optimize/--no-optimize', default=True, show_default=True, help='Refresh the query planner statistics.')
+@with_appcontext
+def db_maintenance(checkpoint, optimize):
+    """Checkpoint the SQLite write-ahead log and optimize the database. Run it periodically, e.g. hourly from cron."""
+    from handicap import db
+    from handicap.sqlite import maintain
+    result = maintain(db.engine, checkpoint, optimize)
+    click.echo(f'Checkpointed {result["checkpointed_pages"]} of {result["log_pages"]} log pages'
+               f'{" (busy; run again later)" if result["busy"] else ""}.')
+
+
+@click.command('course-handicaps')
+@click.argument('tees_file', type=click.File('r'))
+@click.argument('player_ids', nargs=-1, type=int, required=True)
+@click.option('--allowance', type=click.FloatRange(0, 1, min_open=True), default=1.0, show_default=True,
+              help='The handicap allowance of the format, e.g. 0.95 for individual stroke play.')
+@click.option('--date', 'day', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Take the indexes on this date (default: the current ones).')
+@click.option('--format', 'output_format', type=click.Choice(['csv', 'json']), default='csv', show_default=True)
+@with_appcontext
+def course_handicaps_command(tees_file, player_ids, allowance, day, output_format):
+    """
+    Print the course and playing handicaps of a field of players (PLAYER_IDS) on the tees in TEES_FILE,
+    a JSON list of objects with name, course_rating, course_slope, par, and optionally holes and stroke_index.
+    """
+    import json
+    from handicap.competition import field_handicaps, parse_tees, to_csv
+    try:
+        tees = parse_tees(json.load(tees_file))
+    except ValueError as error:     # Including JSON syntax errors.
+        raise click.BadParameter(str(error), param_hint='TEES_FILE')
+    result = field_handicaps(list(player_ids), tees, allowance, day.date() if day else None)
+    for player_id in result['unknown']:
+        click.echo(f'There is no player {player_id}.', err=True)
+    click.echo(to_csv(result) if output_format == 'csv' else json.dumps(result, indent=2), nl=output_format == 'json')
@@ -0,0 +1,151 @@
+import csv
+import io
+import math
+from collections import namedtuple
+from datetime import date
+from sqlalchemy import select
+from handicap import db, metrics
+from handicap.models import User
+from handicap.history import index_in_force
+
+MAX_TEES = 20   # Tees a field's handicaps can be calculated for at once.
+
+# A set of tees: its ratings and par, for 9 or 18 holes, and optionally the stroke index of each hole in playing order.
+Tee = namedtuple('Tee', ['name', 'course_rating', 'course_slope', 'par', 'holes', 'stroke_index'])
+
+def parse_tees(tees: list[dict]) -> list[Tee]:
+    """
+    Check and convert a list of tees given as dicts with name, course_rating, course_slope, par,
+    and optionally holes (9 or 18, by default the length of stroke_index, or 18) and stroke_index.
+
+    Raises:
+    ValueError, with a message saying which tee is wrong and why.
+    """
+    if not isinstance(tees, list) or not tees:
+        raise ValueError('At least one tee is required.')
+    if len(tees) > MAX_TEES:
+        raise ValueError(f'At most {MAX_TEES} tees can be given.')
+    parsed = []
+    for number, tee in enumerate(tees, start=1):
+        if not isinstance(tee, dict):
+            raise ValueError(f'Tee {number} must be an object.')
+        name = str(tee.get('name') or f'Tee {number}')
+        try:
+            course_rating = float(tee['course_rating'])
+            course_slope = int(tee['course_slope'])
+            par = int(tee['par'])
+            stroke_index = [int(hole) for hole in tee['stroke_index']] if tee.get('stroke_index') else None
+            holes = int(tee.get('holes') or (len(stroke_index) if stroke_index else 18))
+        except KeyError as missing:
+            raise ValueError(f'{name}: {missing.args[0]} is required.')
+        except (TypeError, ValueError, OverflowError):     # OverflowError: int() of an infinite float.
+            raise ValueError(f'{name}: course_rating, course_slope, par, holes and stroke_index must be numbers.')
+        if not math.isfinite(course_rating) or not 20 <= course_rating <= 90:    # 9 or 18 holes; float() takes 'inf' and 'nan'.
+            raise ValueError(f'{name}: course_rating must be between 20 and 90.')
+        if not 55 <= course_slope <= 155:
+            raise ValueError(f'{name}: course_slope must be between 55 and 155.')
+        if not 27 <= par <= 90:
+            raise ValueError(f'{name}: par must be between 27 and 90.')
+        if holes not in (9, 18):
+            raise ValueError(f'{name}: holes must be 9 or 18.')
+        if stroke_index and sorted(stroke_index) != list(range(1, holes + 1)):
+            raise ValueError(f'{name}: stroke_index must give each of the {holes} holes a different index from 1 to {holes}.')
+        parsed.append(Tee(name, course_rating, course_slope, par, holes, stroke_index))
+    return parsed
+
+def field_indexes(player_ids: list[int], day: date=None) -> list[tuple[int, str, float | None]]:
+    """
+    Return the (id, name, handicap index) of each of a field of players that exists, in the order given, with one query.
+
+    Parameters:
+    player_ids (list): the players' ids.
+    day (date): the date to take the indexes on, or None for the current ones.
+    """
+    handicap_index = User.handicap_index if day is None else index_in_force(day)
+    players = {player_id: (player_id, name, index) for player_id, name, index in
+               db.session.execute(select(User.id, User.name, handicap_index).where(User.id.in_(player_ids))).tuples()}
+    return [players[player_id] for player_id in dict.fromkeys(player_ids) if player_id in players]
+
+def whs_round(values):
+    """Round to whole numbers, halves upward, as the World Handicap System does. Tiny float errors are rounded off first."""
+    import numpy as np
+    return np.floor(np.round(values, 6) + 0.5)
+
+def course_handicaps(indexes: list, tees: list[Tee], allowance: float=1.0) -> tuple:
+    """
+    Calculate the course and playing handicaps, and the strokes received on each hole, of a field on each set of tees.
+
+    Course Handicap = Handicap Index x (Slope Rating / 113) + (Course Rating - Par), with half the index for
+    9 holes; Playing Handicap = Course Handicap x Handicap Allowance, each rounded. On a hole with stroke index s
+    of n, a playing handicap p receives (p - s) // n + 1 strokes, which gives strokes back for plus handicaps.
+    The whole field is calculated at once, as arrays.
+
+    Parameters:
+    indexes (list): the players' handicap indices, None for a player without one.
+    tees (list): the tees.
+    allowance (float): the handicap allowance of the format, e.g. 0.95 for individual stroke play.
+
+    Returns:
+    A 3-tuple of arrays, NaN for players without an index:
+    the course handicaps and the playing handicaps (players x tees), and for each tee,
+    the strokes received (players x holes), or None if the tee has no stroke index.
+    """
+    import numpy as np
+    index = np.array([np.nan if hi is None else hi for hi in indexes], dtype=float)[:, None]
+    holes = np.array([tee.holes for tee in tees])
+    slope = np.array([tee.course_slope for tee in tees])
+    rating_over_par = np.array([tee.course_rating - tee.par for tee in tees])
+    course = whs_round(index * np.where(holes == 9, 0.5, 1.0) * slope / 113 + rating_over_par)
+    playing = whs_round(course * allowance)
+    strokes = [np.floor_divide(playing[:, [column]] - np.array(tee.stroke_index), tee.holes) + 1
+               if tee.stroke_index else None for column, tee in enumerate(tees)]
+    return course, playing, strokes
+
+@metrics.timed
+def field_handicaps(player_ids: list[int], tees: list[Tee], allowance: float=1.0, day: date=None) -> dict:
+    """
+    Return a field's course and playing handicaps on each set of tees, from their indexes read in one query.
+
+    Parameters:
+    player_ids (list): the players' ids.
+    tees (list): the tees.
+    allowance (float): the handicap allowance of the format.
+    day (date): the date to take the indexes on, or None for the current ones.
+
+    Returns:
+    A dict of the date, the allowance, the tees, the players (in the order given) with their handicaps
+    on each tee, and the unknown ids, ready to be returned as JSON or written with to_csv().
+    """
+    players = field_indexes(player_ids, day)
+    course, playing, strokes = course_handicaps([index for _, _, index in players], tees, allowance)
+    # As lists of Python numbers, which are much quicker to convert one at a time than array elements.
+    course, playing = course.tolist(), playing.tolist()
+    strokes = [tee_strokes.tolist() if tee_strokes is not None else None for tee_strokes in strokes]
+
+    def whole(value):
+        return None if value != value else int(value)   # NaN, for a player without an index, isn't equal to itself.
+
+    known = {player_id for player_id, _, _ in players}
+    return dict(date=day.isoformat() if day else None, allowance=allowance,
+                tees=[tee._asdict() for tee in tees],
+                players=[dict(player_id=player_id, name=name,
+                              handicap_index=round(index, 1) if index is not None else None,
+                              handicaps=[dict(tee=tee.name, course_handicap=whole(course[row][column]),
+                                              playing_handicap=whole(playing[row][column]),
+                                              strokes=[whole(hole) for hole in strokes[column][row]]
+                                                      if strokes[column] is not None else None)
+                                         for column, tee in enumerate(tees)])
+                         for row, (player_id, name, index) in enumerate(players)],
+                unknown=[player_id for player_id in dict.fromkeys(player_ids) if player_id not in known])
+
+def to_csv(result: dict) -> str:
+    """Write field_handicaps()' result as CSV, a row per player and tee, the strokes by hole separated by spaces."""
+    stream = io.StringIO()
+    writer = csv.writer(stream)
+    writer.writerow(['player_id', 'name', 'handicap_index', 'tee', 'course_handicap', 'playing_handicap', 'strokes'])
+    for player in result['players']:
+        for handicap in player['handicaps']:
+            writer.writerow([player['player_id'], player['name'], player['handicap_index'], handicap['tee'],
+                             handicap['course_handicap'], handicap['playing_handicap'],
+                             ' '.join(str(hole) for hole in handicap['strokes'] or ())])
+    return stream.getvalue()
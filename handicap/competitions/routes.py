@@ -0,0 +1,39 @@
+from datetime import date
+from flask import render_template, request, abort, Blueprint, Response
+from flask_login import login_required
+from handicap import leaderboards
+
+competitions = Blueprint('competitions', __name__)
+
+def event_args() -> tuple[str, date]:
+    """Return the course and played date of an event from the query parameters."""
+    course = request.args.get('course', '').strip()
+    try:
+        played = date.fromisoformat(request.args.get('played', ''))
+    except ValueError:
+        abort(400)
+    if not course:
+        abort(400)
+    return course, played
+
+@competitions.route("/leaderboard")
+@login_required
+def leaderboard():
+    course, played = event_args()
+    return render_template('leaderboard.html', title='Leaderboard', course=course, played=played,
+                           standings=leaderboards.get(course, played).standings())
+
+@competitions.route("/leaderboard/stream")
+@login_required
+def leaderboard_stream():
+    """
+    The leaderboard's changes as server-sent events: a snapshot of the board, then a standing event for each
+    player whose round is posted or changed, and a remove event for each whose round is deleted.
+    A reconnecting browser sends Last-Event-ID, and is sent the events it missed.
+    """
+    course, played = event_args()
+    board = leaderboards.get(course, played)
+    subscriber = board.subscribe(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    # Not stream_with_context: the stream holds no request or database session while it waits.
+    return Response(board.stream(subscriber), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,142 @@
+from datetime import date, timedelta
+from flask import current_app
+from sqlalchemy import func, insert, select, tuple_, update
+from handicap import db, snapshots, user_cache, metrics, fragments
+from handicap.models import Score, IndexHistory, PlayingConditions
+
+def unadjusted_differential():
+    """Return the SQL expression of a round's score differential before any playing conditions adjustment."""
+    return (Score.gross_adjusted_score - Score.course_rating) * 113 / Score.course_slope
+
+def index_before_round():
+    """
+    Return a scalar subquery, correlated with Score, of the player's handicap index before the day of the round.
+    It is a seek on the (user_id, date) index of the history, so O(log n) per round.
+    """
+    return select(IndexHistory.handicap_index) \
+               .where(IndexHistory.user_id == Score.user_id, IndexHistory.handicap_index_date < Score.played) \
+               .order_by(IndexHistory.handicap_index_date.desc(), IndexHistory.id.desc()) \
+               .limit(1).correlate(Score).scalar_subquery()
+
+def playing_conditions(scores: int, total_margin: float, min_scores: int, expected_margin: float) -> int:
+    """
+    Calculate the playing conditions adjustment of a day's scores on a course.
+
+    Players' differentials exceed their indexes by expected_margin on average, the index being the average
+    of their better rounds. When the day's acceptable scores exceed their players' indexes by more (or less)
+    than that, the course played harder (or easier) than its rating, and the difference, rounded and limited
+    to -1 to +3 as the World Handicap System limits it, is subtracted from each differential of the day.
+
+    Parameters:
+    scores (int): the number of acceptable scores.
+    total_margin (float): the sum of their differentials less their players' indexes.
+    min_scores (int): the fewest acceptable scores an adjustment is made from.
+    expected_margin (float): the average margin on a day of normal conditions.
+
+    Returns:
+    The adjustment, a whole number from -1 to 3; 0 if there are too few scores.
+    """
+    if scores < min_scores:
+        return 0
+    difference = round(total_margin / scores - expected_margin, 6)
+    return max(-1, min(3, int((difference + 0.5) // 1)))
+
+def refresh_conditions(days) -> None:
+    """
+    Bring the running totals of the days (courses and dates) on which rounds were posted, changed or deleted
+    up to date, and mark them for adjustment. Only the rounds of those days are read, with a seek on the
+    (played, course) index of the rounds, and their players' indexes, so the cost is that of the fields.
+    The changes are added to the session; the caller commits them.
+
+    Parameters:
+    days: (course, played) pairs. Rounds without a course are left out.
+    """
+    days = {(course, played) for course, played in days if course}
+    if not days:
+        return
+    totals = {(course, played): (0, 0.0) for course, played in days}
+    handicap_index = index_before_round()
+    rows = db.session.execute(select(Score.course, Score.played, func.count(), func.sum(unadjusted_differential() - handicap_index))
+                              .where(tuple_(Score.played, Score.course).in_([(played, course) for course, played in days]),
+                                     Score.holes == 18, handicap_index <= current_app.config['PCC_MAX_INDEX'])
+                              .group_by(Score.course, Score.played)).tuples()
+    for course, played, scores, total_margin in rows:
+        totals[course, played] = (scores, total_margin or 0.0)
+    existing = set(db.session.execute(select(PlayingConditions.course, PlayingConditions.played)
+                                      .where(tuple_(PlayingConditions.course, PlayingConditions.played).in_(days))).tuples())
+    rows = [dict(course=course, played=played, scores=scores, total_margin=total_margin, pending=True)
+            for (course, played), (scores, total_margin) in totals.items()]
+    if any(day not in existing for day in totals):
+        db.session.execute(insert(PlayingConditions), [dict(row, pcc=0) for row in rows
+                                                       if (row['course'], row['played']) not in existing])
+    if existing:
+        db.session.execute(update(PlayingConditions), [row for row in rows if (row['course'], row['played']) in existing])
+
+def rebuild_conditions(chunk_size: int=1000) -> int:
+    """
+    Refresh the running totals of every day with rounds on it and mark them for adjustment, a chunk of days
+    (and a transaction) at a time. A one-off, e.g. for rounds posted before the totals were kept, as it reads every round.
+
+    Returns:
+    The number of days refreshed.
+    """
+    days = db.session.execute(select(Score.course, Score.played).where(Score.course.is_not(None)).distinct()).tuples().all()
+    for start in range(0, len(days), chunk_size):
+        refresh_conditions(days[start:start + chunk_size])
+        db.session.commit()
+    return len(days)
+
+@metrics.timed
+def apply_playing_conditions(through: date=None, chunk_size: int=1000) -> tuple[int, int]:
+    """
+    Apply the playing conditions adjustment of each day marked for it, a batch job run after the day's play.
+
+    The day's running totals are refreshed, its adjustment calculated, and the differentials of its rounds
+    that were adjusted differently are recalculated with it. The index history of each player with an
+    adjusted round is then replayed from the earliest such round, leaving earlier history untouched,
+    and the player's version bumped. All in one transaction; if a player's record changes meanwhile,
+    the commit fails with StaleDataError and nothing is written, so the job can simply be run again.
+
+    Parameters:
+    through (date): the last day to adjust, by default yesterday, as today's rounds may still be coming in.
+    chunk_size (int): the number of days read at a time.
+
+    Returns:
+    A tuple of the number of days adjusted and the number of players whose records were replayed.
+    """
+    from handicap.handicap import ScoringRecord
+    through = through or date.today() - timedelta(days=1)
+    days = db.session.execute(select(PlayingConditions.course, PlayingConditions.played)
+                              .where(PlayingConditions.pending, PlayingConditions.played <= through)).tuples().all()
+    if not days:
+        return 0, 0
+    config = current_app.config
+    replay_from = {}    # Player id: the earliest date of an adjusted round.
+    for start in range(0, len(days), chunk_size):
+        chunk = days[start:start + chunk_size]
+        refresh_conditions(chunk)
+        for conditions in db.session.scalars(select(PlayingConditions)
+                                             .where(tuple_(PlayingConditions.course, PlayingConditions.played).in_(chunk))).all():
+            pcc = playing_conditions(conditions.scores, conditions.total_margin, config['PCC_MIN_SCORES'],
+                                     config['PCC_EXPECTED_MARGIN'])
+            conditions.pending = False
+            if pcc == conditions.pcc == 0:
+                continue    # New and edited rounds have no adjustment, so none need changing.
+            # Differential = (113 / Slope Rating) x (Adjusted Gross Score - Course Rating - PCC).
+            adjusted = db.session.execute(update(Score)
+                                          .where(Score.played == conditions.played, Score.course == conditions.course,
+                                                 Score.pcc != pcc)
+                                          .values(score_differential=(Score.gross_adjusted_score - Score.course_rating - pcc)
+                                                                     * 113 / Score.course_slope, pcc=pcc)
+                                          .returning(Score.user_id).execution_options(synchronize_session=False))
+            for player_id in adjusted.scalars():
+                replay_from[player_id] = min(replay_from.get(player_id, conditions.played), conditions.played)
+            conditions.pcc = pcc
+    for player_id, played in replay_from.items():
+        ScoringRecord(player_id).replayFrom(played)
+    db.session.commit()
+    for player_id in replay_from:
+        snapshots.invalidate(player_id)
+        fragments.invalidate(player_id)
+        user_cache.invalidate(player_id)
+    return len(days), len(replay_from)
@@ -9,3 +9,50 @@ class Config:
     MAIL_USE_SSL = False
     MAIL_USERNAME = os.environ.get('MAIL_USER')
     MAIL_PASSWORD = os.environ.get('MAIL_PASS')
+    MAIL_WORKERS = 2            # Threads sending queued mail (0 sends mail in the request).
+    MAIL_QUEUE_SIZE = 100       # Messages waiting to be sent before more are refused.
+    MAIL_BATCH_SIZE = 20        # Messages a worker sends over its connection before checking the queue again.
+    MAIL_RETRIES = 3            # Retries of a failed message, backing off from MAIL_RETRY_BACKOFF seconds.
+    MAIL_RETRY_BACKOFF = 1.0
+    MAIL_IDLE_SECONDS = 5.0     # An idle worker closes its SMTP connection after this long.
+    PICTURE_WORKERS = 1         # Processes resizing uploaded profile pictures (0 resizes them in the request).
+    SNAPSHOT_CACHE_SIZE = 1024  # Players whose handicap snapshot is kept in memory.
+    USER_CACHE_SIZE = 1024      # Logged in users kept in memory between requests.
+    USER_CACHE_TTL = 30         # Seconds a cached user is used for before it is loaded again.
+    METRICS_ENABLED = True      # Collect request, SQL and handicap calculation metrics and serve them on /metrics.
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')     # If set, /metrics needs 'Authorization: Bearer <token>'.
+    SLOW_REQUEST_SECONDS = float(os.environ['SLOW_REQUEST_SECONDS']) if os.environ.get('SLOW_REQUEST_SECONDS') else None   # Log slower requests with their SQL.
+    SCHEMA_CHECK = 'version'    # 'version': upgrade the schema at start up only if the models changed; 'always': every start.
+    SQLITE_PRAGMAS = {}         # PRAGMA settings for each new SQLite connection.
+    SQLITE_IMMEDIATE_WRITES = False     # Begin transactions that may write with BEGIN IMMEDIATE.
+    FRAGMENT_CACHE_SIZE = 4096  # Rendered template fragments kept per worker process.
+    TEMPLATE_BYTECODE_CACHE = None  # Directory of compiled templates; None: the instance folder's jinja_cache, '': none.
+    STATIC_FINGERPRINT = True   # Link static files under names with a hash of their contents, cached for good.
+    STATIC_BUILD_FOLDER = None  # Directory of precompressed static files; None: the instance folder's static_build.
+    COMPRESS_LEVEL = 6          # Gzip level for HTML and JSON responses.
+    COMPRESS_MIN_SIZE = 500     # Smaller responses are sent uncompressed.
+    PCC_MIN_SCORES = 8          # The fewest acceptable scores on a course on a day that a playing conditions adjustment is made from.
+    PCC_MAX_INDEX = 36.0        # Scores by players with a higher index are left out of the adjustment.
+    PCC_EXPECTED_MARGIN = 3.0   # How far differentials exceed their players' indexes on average in normal conditions.
+    LEADERBOARDS = 32           # Event leaderboards kept in memory, besides those being watched.
+    LEADERBOARD_POLL_SECONDS = 2.0      # How often a watched leaderboard picks up rounds posted by other processes.
+    LEADERBOARD_QUEUE_SIZE = 100        # Events queued for a watcher before it is sent the whole board instead.
+    LEADERBOARD_HISTORY = 1000  # Events kept per leaderboard for watchers resuming from Last-Event-ID.
+    LEADERBOARD_KEEPALIVE_SECONDS = 15.0    # Quiet time before a comment is sent to keep an event stream open.
+
+class ProductionConfig(Config):
+    """
+    SQLite set up for many concurrent readers: the write-ahead log lets pages be read while a score is posted.
+    Select with HANDICAP_CONFIG=handicap.config.ProductionConfig.
+    """
+    SQLITE_PRAGMAS = {'journal_mode': 'WAL',
+                      'synchronous': 'NORMAL',      # Safe with WAL; the log is synced at checkpoints.
+                      'busy_timeout': 30000,        # Milliseconds a writer waits for the write lock.
+                      'mmap_size': 268435456,       # Read the database through 256 MiB of memory map.
+                      'cache_size': -65536,         # 64 MiB page cache per connection.
+                      'temp_store': 'MEMORY'}
+    SQLITE_IMMEDIATE_WRITES = True
+    # A pool per process, big enough for its threads; each process opens its own connections.
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 30,
+                                 'connect_args': {'timeout': 30}}
+    METRICS_ENABLED = bool(Config.METRICS_TOKEN)   # /metrics shows every endpoint's traffic, so only behind a token.
@@ -0,0 +1,94 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+class FragmentCache():
+    """
+    A bounded, least recently used cache of rendered template fragments of the logged in player's pages,
+    keyed by user id, fragment name and the fragment's own key (e.g. the page number).
+
+    Each fragment is kept with the version of the player's data it was rendered from, and only used while
+    the player's version matches, so a write that bumps the version is never shown stale; the write paths
+    also invalidate the player's fragments, to free them at once. The cache lives in the worker process.
+
+    Templates cache a fragment with a call block, rendering its body only on a miss:
+        {% call fragment('counting-rounds') %} ... {% endcall %}
+    Anonymous visitors' fragments are rendered every time.
+
+    The app's compiled templates are also kept on disk (TEMPLATE_BYTECODE_CACHE, by default in the
+    instance folder), so new worker processes load them instead of compiling them again.
+    """
+
+    def __init__(self, app=None, maxsize: int=4096) -> None:
+        self.maxsize = maxsize
+        self._fragments = OrderedDict()     # (user id, name, *key): (version, markup).
+        self._keys = {}                     # User id: the keys of the user's fragments.
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.maxsize = app.config.get('FRAGMENT_CACHE_SIZE', self.maxsize)
+        self.clear()
+        app.add_template_global(self.fragment)
+        directory = app.config.get('TEMPLATE_BYTECODE_CACHE')
+        if directory is None:
+            directory = os.path.join(app.instance_path, 'jinja_cache')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    def get(self, user_id: int, version: int, key: tuple) -> Markup | None:
+        with self._lock:
+            entry = self._fragments.get((user_id, *key))
+            if entry is None or entry[0] != version:
+                return None
+            self._fragments.move_to_end((user_id, *key))    # Most recently used.
+            return entry[1]
+
+    def put(self, user_id: int, version: int, key: tuple, markup: Markup) -> None:
+        with self._lock:
+            self._fragments[(user_id, *key)] = (version, markup)
+            self._fragments.move_to_end((user_id, *key))
+            self._keys.setdefault(user_id, set()).add(key)
+            while len(self._fragments) > self.maxsize:
+                (evicted, *evicted_key), _ = self._fragments.popitem(last=False)   # Evict the least recently used.
+                self._forget(evicted, tuple(evicted_key))
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            for key in self._keys.pop(user_id, ()):
+                self._fragments.pop((user_id, *key), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._fragments.clear()
+            self._keys.clear()
+
+    def _forget(self, user_id: int, key: tuple) -> None:
+        keys = self._keys.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[user_id]
+
+    def fragment(self, name: str, *key, caller) -> Markup:
+        """
+        Return the logged in player's fragment, rendering it with caller (the body of the template's
+        call block) if it is not cached for the current version of the player's data.
+
+        Parameters:
+        name (str): the fragment's name, unique among the app's templates.
+        key: whatever else the fragment depends on, e.g. the page number; hashable values.
+        """
+        if not current_user.is_authenticated:
+            return caller()
+        user_id, version = current_user.id, current_user.version
+        markup = self.get(user_id, version, (name, *key))
+        if markup is None:
+            markup = Markup(caller())
+            self.put(user_id, version, (name, *key), markup)
+        return markup
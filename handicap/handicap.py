@@ -1,26 +1,381 @@
+from array import array
+from collections import namedtuple
 from datetime import date, timedelta
-from handicap import db
+from sortedcontainers import SortedKeyList
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import delete, func, insert, select, tuple_
+from sqlalchemy.orm import aliased
+from handicap import db, snapshots, user_cache, metrics, fragments
 from handicap.models import User, Score, NineHoleScore, IndexHistory
+from handicap.history import IndexTimeline, YEAR, history_query
+from handicap.conditions import refresh_conditions
+from handicap.snapshots import Snapshot, CountingRound
+
+WINDOW_SIZE = 20    # The number of most recent rounds considered for a handicap index.
+REPLAY_PAGE_SIZE = 1000     # Rounds read at a time when replaying a history.
+
+# A round as the handicap calculation sees it. Tuples compare in played date then id order.
+Round = namedtuple('Round', ['played', 'id', 'score_differential'])
+# A round as pages show it, read with a column-only query, so it never joins the session and can't be changed by a page.
+ScoreView = namedtuple('ScoreView', ['id', 'played', 'course', 'course_rating', 'course_slope', 'gross_adjusted_score',
+                                     'holes', 'score_differential', 'pcc', 'user_id'])
+SCORE_VIEW_COLUMNS = [getattr(Score, field) for field in ScoreView._fields]
+
+def score_views(query) -> list[ScoreView]:
+    """Return the rounds a query of SCORE_VIEW_COLUMNS selects, as ScoreViews."""
+    return [ScoreView._make(row) for row in db.session.execute(query)]
+
+def score_view(score_id: int) -> ScoreView | None:
+    """Return a round as a ScoreView, or None if there is no such round."""
+    views = score_views(select(*SCORE_VIEW_COLUMNS).where(Score.id == score_id))
+    return views[0] if views else None
+
+class ScoreViewPagination(Pagination):
+    """A page of ScoreViews from a select of SCORE_VIEW_COLUMNS, counted from a total already known rather than by a query."""
+
+    def _query_items(self) -> list[ScoreView]:
+        return score_views(self._query_args['select'].limit(self.per_page).offset(self._query_offset))
+
+    def _query_count(self) -> int:
+        return self._query_args['total']
+
+def counting_size(rounds_played: int) -> tuple[int, int]:
+    """
+    Look up how many of the most recent score differentials count towards the handicap index.
+
+    Parameters:
+    rounds_played (int): the number of 18 hole rounds in the scoring record.
+
+    Returns:
+    A tuple of:
+    the number of lowest score differentials to average (0 if there are too few rounds), and
+    the adjustment to add to their average.
+    """
+    if rounds_played < 3:
+        return 0, 0
+    elif rounds_played < 6:
+        return 1, -2 if rounds_played == 3 else -1 if rounds_played == 4 else 0
+    elif rounds_played < 9:
+        return 2, -1 if rounds_played == 6 else 0
+    elif rounds_played < 20:
+        return 3 if rounds_played < 12 else \
+               4 if rounds_played < 15 else \
+               5 if rounds_played < 17 else \
+               6 if rounds_played < 19 else \
+               7, 0
+    else:
+        # rounds_played >= 20
+        return 8, 0     # Average of the lowest 8 rounds
+
+def adjusted_index(average: float, rounds_played: int, adjustment: int, low_handicap_index: float) -> float:
+    """
+    Turn the average of the counting score differentials into a handicap index.
+
+    Parameters:
+    average (float): the average of the lowest score differentials.
+    rounds_played (int): the number of 18 hole rounds in the scoring record.
+    adjustment (int): the adjustment for a short record, from counting_size().
+    low_handicap_index (float): the low handicap index, used for the caps once there are 20 rounds.
+
+    Returns:
+    The handicap index, rounded, capped or adjusted, and limited to the maximum.
+    """
+    handicap_index = round(average, 1)
+    if rounds_played >= 20:
+        # Apply the caps.
+        if handicap_index - low_handicap_index > 3:
+            restricted_amount = (handicap_index - (low_handicap_index + 3)) / 2   # 50% of additional amount
+            handicap_index += restricted_amount
+        if handicap_index - low_handicap_index > 5:
+            handicap_index = low_handicap_index + 5
+    else:
+        # Apply the adjustment.
+        handicap_index += adjustment
+
+    # Maximum handicap.
+    if handicap_index > 54:
+        handicap_index = 54
+
+    return handicap_index
+
+def reevaluate_low_index(played: date, score_differential: float, handicap_index: float,
+                         low_handicap_index: float, low_handicap_index_date: date,
+                         timeline: IndexTimeline) -> tuple[float, float, date]:
+    """
+    Re-evaluate the Low Handicap Index after a round, once there are at least 20 rounds in the record.
+
+    Parameters:
+    played (date): the date the round was played.
+    score_differential (float): the round's score differential.
+    handicap_index (float): the handicap index calculated with the round.
+    low_handicap_index (float), low_handicap_index_date (date): the low handicap index before the round.
+    timeline (IndexTimeline): the index history up to the round, at least for the year before it.
+
+    Returns:
+    A 3-tuple of the handicap index after any exceptional score reduction, and the new low handicap index and its date.
+    """
+    time_between_round_and_lowHI = abs(played - low_handicap_index_date)
+    if time_between_round_and_lowHI > YEAR:
+        # reset the low HI to the lowest in the preceding year (the earliest, if it was reached more than once).
+        years_lowest = timeline.lowest(played - YEAR, played)
+        if years_lowest:
+            low_handicap_index_date, low_handicap_index = years_lowest
+    # Check for exceptional score.
+    check_exceptional_round = round(score_differential - handicap_index, 1)
+    if 7.0 <= check_exceptional_round <= 9.9:
+        handicap_index -= 1.0
+    elif check_exceptional_round >= 10:
+        handicap_index -= 2.0
+
+    if handicap_index < low_handicap_index:
+        # Reset the low handicap to the new one just computed.
+        low_handicap_index = handicap_index
+        low_handicap_index_date = played
+
+    return handicap_index, low_handicap_index, low_handicap_index_date
+
+# A player's handicap figures and counting rounds, as countingRounds() gives them, read for a whole field at once.
+PlayerRecord = namedtuple('PlayerRecord', ['id', 'name', 'handicap_index', 'low_handicap_index', 'low_handicap_index_date',
+                                           'rounds_played', 'counting_rounds'])
+
+@metrics.timed
+def player_records(player_ids: list[int]) -> dict[int, PlayerRecord]:
+    """
+    Return the handicap figures and counting rounds of a field of players, with one query.
+
+    Each player is joined to the rounds in their window of most recent rounds, found by a correlated
+    subquery that seeks the (user_id, played) index, and their rounds are counted on the same index,
+    so the cost is that of the windows rather than of the players' whole records. The counting rounds
+    are then picked from each window as countingRounds() picks them, without building a ScoringRecord per player.
+
+    Returns:
+    A dict of player id: PlayerRecord. Ids of players that don't exist are left out.
+    """
+    recent = aliased(Score)
+    window = select(recent.id).where(recent.user_id == User.id) \
+                 .order_by(recent.played.desc(), recent.id.desc()).limit(WINDOW_SIZE).correlate(User)
+    rounds_played = select(func.count()).select_from(recent).where(recent.user_id == User.id).correlate(User).scalar_subquery()
+    rows = db.session.execute(select(User.id, User.name, User.handicap_index, User.low_handicap_index,
+                                     User.low_handicap_index_date, rounds_played, *SCORE_VIEW_COLUMNS)
+                              .outerjoin(Score, Score.id.in_(window))
+                              .where(User.id.in_(player_ids))
+                              .order_by(User.id, Score.played.desc(), Score.id.desc()))
+    records, windows = {}, {}
+    for player_id, name, handicap_index, low, low_date, played_count, *score in rows:
+        if player_id not in records:
+            records[player_id] = (name, handicap_index, low, low_date, played_count)
+            windows[player_id] = []
+        if score[0] is not None:
+            windows[player_id].append(ScoreView._make(score))   # Most recent first.
+    result = {}
+    for player_id, (name, handicap_index, low, low_date, played_count) in records.items():
+        count, _ = counting_size(played_count)
+        size = min(played_count, WINDOW_SIZE)
+        # The lowest differentials, ties going to the more recent round, shown in played date order.
+        counting = sorted(sorted(enumerate(windows[player_id], start=1),
+                                 key=lambda ranked: (ranked[1].score_differential, ranked[0]))[:count])
+        result[player_id] = PlayerRecord(player_id, name, handicap_index, low, low_date, played_count,
+                                         [(recency, score, size) for recency, score in counting])
+    return result
+
+class Rounds():
+    """
+    A compact list of rounds for calculation, held column-wise in arrays:
+    played dates as day ordinals, score differentials as doubles and ids as integers.
+
+    Rounds are appended as (played, id, score_differential) triples, e.g. the rows of a column-only query,
+    so no Score objects or session identity map are involved, and come back out as Round tuples.
+    """
+
+    __slots__ = ('played', 'score_differential', 'id')
+
+    def __init__(self, rounds=()) -> None:
+        self.played = array('i')
+        self.score_differential = array('d')
+        self.id = array('q')
+        for played, round_id, score_differential in rounds:
+            self.append(played, round_id, score_differential)
+
+    @classmethod
+    def load(cls, query) -> 'Rounds':
+        """Load the rounds selected by a query of the played, id and score_differential columns, in that order."""
+        return cls(db.session.execute(query))
+
+    def append(self, played: date, round_id: int, score_differential: float) -> None:
+        self.played.append(played.toordinal())
+        self.id.append(round_id)
+        self.score_differential.append(score_differential)
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    def __getitem__(self, index: int) -> Round:
+        return Round(date.fromordinal(self.played[index]), self.id[index], self.score_differential[index])
+
+    def __iter__(self):
+        for played, round_id, score_differential in zip(self.played, self.id, self.score_differential):
+            yield Round(date.fromordinal(played), round_id, score_differential)
+
+class RoundsWindow():
+    """
+    The rounds of a scoring record, maintained so the counting rounds never need a full re-sort.
+
+    All rounds are kept in played date order (ties broken by id, so the later posting is the more recent),
+    and the rounds inside the window of most recent rounds are also kept in score differential order
+    (ties going to the more recent round).
+    Adding, replacing or removing a round therefore costs O(log n), and the lowest differentials
+    of the window are read straight off the front of the differential ordering.
+    The window must be told about a change to a round's date or differential through replace(),
+    using the round as it was before the change.
+
+    Only the most recent rounds need to be supplied: rounds_played counts the whole record,
+    and any rounds not supplied are taken to be older than those that were.
+    """
+
+    def __init__(self, rounds=(), size: int=WINDOW_SIZE, rounds_played: int=None) -> None:
+        self.size = size
+        self._by_date = SortedKeyList(rounds, key=lambda x: (x.played, x.id))
+        self._unloaded = rounds_played - len(self._by_date) if rounds_played is not None else 0
+        self._by_differential = SortedKeyList(self._by_date[-size:],
+                                              key=lambda x: (x.score_differential, -x.played.toordinal(), -x.id))
+
+    def __len__(self) -> int:
+        return self.rounds_played
+
+    @property
+    def rounds_played(self) -> int:
+        return len(self._by_date) + self._unloaded
+
+    def add(self, golf_round) -> None:
+        """Add a round, moving the oldest round out of the window if the new one displaces it."""
+        self._by_date.add(golf_round)
+        if self._by_date.index(golf_round) >= len(self._by_date) - self.size:
+            self._by_differential.add(golf_round)
+            if len(self._by_date) > self.size:
+                # The round that was the oldest in the window drops out of it.
+                self._by_differential.remove(self._by_date[-self.size - 1])
+
+    def trim(self) -> None:
+        """Forget the rounds older than the window, still counting them in rounds_played, so a long replay holds only the window."""
+        surplus = len(self._by_date) - self.size
+        if surplus > 0:
+            del self._by_date[:surplus]
+            self._unloaded += surplus
+
+    def discard(self, golf_round) -> None:
+        """Remove a round, moving the next most recent round into the window if needed."""
+        position = self._by_date.index(golf_round)
+        in_window = position >= len(self._by_date) - self.size
+        if in_window and self._unloaded and len(self._by_date) <= self.size:
+            raise LookupError('The round to refill the window was not loaded.')
+        del self._by_date[position]
+        if in_window:
+            self._by_differential.remove(golf_round)
+            if len(self._by_date) >= self.size:
+                # The most recent round outside the window joins it.
+                self._by_differential.add(self._by_date[-self.size])
+
+    def replace(self, old_round, new_round) -> None:
+        """Replace a round, e.g. when its date or score differential has been edited."""
+        self.discard(old_round)
+        self.add(new_round)
+
+    def latest(self):
+        """Return the most recently played round, or None for an empty record."""
+        return self._by_date[-1] if self._by_date else None
+
+    def recency(self, golf_round) -> int:
+        """Return where a round is in the played date order, 1 being the most recent."""
+        return len(self._by_date) - self._by_date.index(golf_round)
+
+    def lowest(self, count: int) -> list:
+        """Return up to count rounds from the window with the lowest score differentials, lowest first."""
+        return self._by_differential[:count]
 
 class ScoringRecord():
 
-    rounds: list[Score] = []
-    years_handicaps: list[tuple[date, float]] = []     # Keep handicap indices of the previous year.
-    handicap_index: float = None
-    low_handicap_index: float = None
-    low_handicap_index_date: date = None
-    nine_hole_waiting: Score = None
-
-    def __init__(self, player_id=None) -> None:
-        self.player = User.query.get(player_id)
-        self.rounds = self.player.scores
+    def __init__(self, player: User | int=None) -> None:
+        # Share the request's user, if given, rather than fetching it again.
+        self.player = player if isinstance(player, User) else db.session.get(User, player)
+        self.rounds = self.recentRounds(WINDOW_SIZE)
         self.handicap_index = self.player.handicap_index
         self.low_handicap_index = self.player.low_handicap_index
         self.low_handicap_index_date = self.player.low_handicap_index_date
-        self.years_handicaps = [(HI.handicap_index_date, HI.handicap_index) for HI in self.player.indexes]
+        self.timeline = IndexTimeline()     # The index history of the previous year. Loaded when a round is added.
         self.nine_hole_waiting = None
+        self.window = RoundsWindow(self.rounds, rounds_played=self.roundsPlayed())
+
+    @classmethod
+    def fromRounds(cls, rounds: Rounds, low_handicap_index: float=None, low_handicap_index_date: date=None) -> 'ScoringRecord':
+        """
+        Build a scoring record from rounds alone, with no player or database, so it can be used outside an app context.
+        Rounds are then added with applyRound() and the handicap index read from handicapIndex().
+
+        Parameters:
+        rounds (Rounds): the rounds played so far, in any order.
+        low_handicap_index (float), low_handicap_index_date (date): the low handicap index, if there are 20 rounds or more.
+        """
+        record = cls.__new__(cls)
+        record.player = None
+        record.rounds = rounds
+        record.handicap_index = None
+        record.low_handicap_index = low_handicap_index
+        record.low_handicap_index_date = low_handicap_index_date
+        record.timeline = IndexTimeline()
+        record.nine_hole_waiting = None
+        record.window = RoundsWindow(rounds)
+        return record
+
+    @staticmethod
+    @metrics.timed
+    def snapshot(player: User) -> Snapshot:
+        """
+        Return the player's handicap snapshot, calculating it only if the cached one is missing or out of date.
+
+        Parameters:
+        player (User): the player, whose version tells whether the cached snapshot is current.
+
+        Returns:
+        A Snapshot of the handicap index, low handicap index and its date, and the counting rounds
+        (as CountingRound tuples in the 3-tuples returned by countingRounds).
+        """
+        snapshot = snapshots.get(player.id)
+        if snapshot is None or snapshot.version != player.version:
+            record = ScoringRecord(player)
+            handicap_index = record.handicapIndex()
+            counting_rounds = [(index, CountingRound(round.id, round.played, round.course,
+                                                     round.gross_adjusted_score, round.score_differential), window)
+                               for index, round, window in record.countingRounds()]
+            snapshot = Snapshot(handicap_index, record.low_handicap_index, record.low_handicap_index_date,
+                                counting_rounds, record.player.version)
+            snapshots.put(player.id, snapshot)
+        return snapshot
+
+    @metrics.timed
+    def roundsPlayed(self) -> int:
+        """Return the number of 18 hole rounds in the player's record, counted by the database."""
+        return db.session.scalar(select(func.count()).select_from(Score).where(Score.user_id == self.player.id))
+
+    @metrics.timed
+    def recentRounds(self, count: int, before: date=None) -> Rounds:
+        """
+        Return the player's most recently played rounds, with only the columns the handicap calculation needs.
+
+        Parameters:
+        self (ScoringRecord): the self object.
+        count (int): the number of rounds to return.
+        before (date): if given, only rounds played before this date are returned.
 
-    def scorePage(self, per_page: int, page: int, descending=True) -> tuple[list[Score], list[int | None]]:
+        Returns:
+        Rounds holding up to count rounds, most recent first.
+        """
+        query = select(Score.played, Score.id, Score.score_differential).where(Score.user_id == self.player.id)
+        if before:
+            query = query.where(Score.played < before)
+        return Rounds.load(query.order_by(Score.played.desc(), Score.id.desc()).limit(count))
+
+    @metrics.timed
+    def scorePage(self, per_page: int, page: int, descending=True) -> tuple[list[ScoreView], list[int | None]]:
         """
         Return all the rounds played by the player.
 
@@ -32,18 +387,61 @@ class ScoringRecord():
 
         Returns:
         A tuple of:
-        a list of Score objects for the rounds played by the player, and
+        a list of ScoreViews for the rounds played by the player, and
         a list of page numbers for the pagination (None denotes elipses).
         """
-        scores = Score.query.filter_by(user_id=self.player.id)\
-                            .order_by(Score.played.desc() if descending else Score.played.asc())\
-                            .paginate(page=page, per_page=per_page)
+        order = (Score.played.desc(), Score.id.desc()) if descending else (Score.played.asc(), Score.id.asc())
+        # The record has counted the rounds already, so only the page is queried.
+        scores = ScoreViewPagination(page=page, per_page=per_page, max_per_page=None, total=self.window.rounds_played,
+                                     select=select(*SCORE_VIEW_COLUMNS).where(Score.user_id == self.player.id).order_by(*order))
 
         page_nos = scores.iter_pages(left_edge=4, right_edge=1, left_current=1, right_current=2)
 
         return list(scores), list(page_nos)
 
-    def countingRounds(self) -> list[Score]:
+    @metrics.timed
+    def scoreSeek(self, per_page: int, after: tuple=None, before: tuple=None,
+                  descending=True) -> tuple[list[ScoreView], bool, bool]:
+        """
+        Return a page of the rounds played by the player, seeking to it by (played, id) rather than counting
+        an offset, so a page deep in the history costs the same as the first.
+
+        Parameters:
+        self (ScoringRecord): the self object.
+        per_page (int): the number of rounds to display per page.
+        after (tuple): the (played, id) of the last round on the page before, to return the page following it.
+        before (tuple): the (played, id) of the first round on the page after, to return the page preceding it.
+        If neither is given, the first page is returned.
+        descending (bool): True for most recent rounds first, False for oldest round first.
+
+        Returns:
+        A tuple of:
+        a list of ScoreViews for the page, in display order,
+        True if there is a page before it, and
+        True if there is a page after it.
+        """
+        key = tuple_(Score.played, Score.id)
+        forward = before is None
+        query = select(*SCORE_VIEW_COLUMNS).where(Score.user_id == self.player.id)
+        if after is not None:
+            query = query.where(key < after if descending else key > after)
+        if before is not None:
+            query = query.where(key > before if descending else key < before)
+        # Read backwards from the page after to find the page before it.
+        if descending == forward:
+            query = query.order_by(Score.played.desc(), Score.id.desc())
+        else:
+            query = query.order_by(Score.played.asc(), Score.id.asc())
+        scores = score_views(query.limit(per_page + 1))     # One more than the page shows whether there is another page.
+        more = len(scores) > per_page
+        scores = scores[:per_page]
+        if forward:
+            return scores, after is not None, more
+        scores.reverse()
+        return scores, more, True
+
+    @metrics.timed
+    def countingRounds(self) -> list[tuple[int, ScoreView, int]]:
         """
         Return the rounds counting towards the player's handicap.
 
@@ -56,43 +454,42 @@ class ScoringRecord():
         Typically, they are the 8 lowest score differentials of the 20 most recently played rounds,
         modified as scores are accumulated.
         """
-        rounds_played = len(self.rounds)
-
-        N = rounds_played
-
-        if rounds_played < 3:
-            return []
-        elif rounds_played < 6:
-            M = 1
-        elif rounds_played < 9:
-            M = 2
-        elif rounds_played < 20:
-            M = 3 if rounds_played < 12 else \
-                4 if rounds_played < 15 else \
-                5 if rounds_played < 17 else \
-                6 if rounds_played < 19 else \
-                7
-        else:
-            # rounds_played >= 20
-            N = 20  # Get the 20 most recent rounds.
-            M = 8   # Average of the lowest 8 rounds
+        rounds_played = self.window.rounds_played
+        M, _ = counting_size(rounds_played)
+        N = min(rounds_played, self.window.size)
 
         # Get the M best scoring differentials from the N most recent rounds.
-        sorted_rounds = sorted(self.rounds, key=lambda x: x.played, reverse=True)
-        N_most_recent = sorted_rounds[:N]
-        # Index the round from 1 to n to show user where the counting round is in the list.
-        N_indexed_rounds = [(index + 1, round, N) for index, round in enumerate(N_most_recent)]
-        # Sort the 3-tuple list by the score differential.
-        sorted_differentials = sorted(N_indexed_rounds, key=lambda x: x[1].score_differential)
-        M_best_differentials = sorted_differentials[:M]
+        best_differentials = self.window.lowest(M)
+        # Fetch the rest of each counting round, for display.
+        scores = {score.id: score for score in
+                  score_views(select(*SCORE_VIEW_COLUMNS).where(Score.id.in_([round.id for round in best_differentials])))}
+        # Index the round from 1 to N to show user where the counting round is in the list.
+        M_best_differentials = [(self.window.recency(round), scores[round.id], N) for round in best_differentials]
 
         # Restore the played date order for display.
-        return sorted(M_best_differentials, key=lambda x: x[1].played, reverse=True)
+        return sorted(M_best_differentials, key=lambda x: x[0])
     
-    def addRound(self, golf_round: Score) -> str:
+    @metrics.timed
+    def eighteenHoleRound(self, golf_round: Score, rounds_played: int=None) -> Score | None:
+        """
+        Return the 18 hole round to add to the scoring record for a posted round.
 
+        An 18 hole round is returned as it is. While there are fewer than 3 rounds in the record, a 9 hole round
+        is combined with the one waiting (or waits for the next one); after that it is converted to 18 holes.
+        Changes to the waiting 9 hole round are added to the session; the caller commits them.
+
+        Parameters:
+        self (ScoringRecord): the self object.
+        golf_round (Score): the round posted.
+        rounds_played (int): the number of 18 hole rounds already in the record, if not those in the window.
+
+        Returns:
+        The 18 hole Score to add, or
+        None, if a 9 hole round is left waiting for another.
+        """
+        rounds_played = self.window.rounds_played if rounds_played is None else rounds_played
         if golf_round.holes == 9:
-            if len(self.rounds) < 3:
+            if rounds_played < 3:
                 # Combine if a nine hole round is waiting
                 self.nine_hole_waiting = NineHoleScore.query.filter_by(user_id=self.player.id).first()
                 if self.nine_hole_waiting:
@@ -114,7 +511,6 @@ class ScoringRecord():
                                                            gross_adjusted_score=golf_round.gross_adjusted_score,
                                                            course=golf_round.course, user_id=self.player.id)
                     db.session.add(self.nine_hole_waiting)
-                    db.session.commit()
 
                     return None
 
@@ -129,51 +525,179 @@ class ScoringRecord():
 
             # Use the combined two nine hole scores or inflated 9 to 18 hole score to add to the score record
             golf_round = combine_9_hole_rounds
-        
-        # Add the 18 hole round to the scoring record.
+
+        return golf_round
+
+    @metrics.timed
+    def addRound(self, golf_round: Score) -> str:
+        """
+        Post a round to the scoring record as one unit of work.
+
+        The round, its index history entry and the player's handicap and low handicap index are
+        written in a single transaction with one commit. The player's version is bumped in the same
+        commit, so if another change to the player's record was committed since it was read, the commit
+        fails with StaleDataError and nothing is written; the caller rolls back and may try again.
+
+        Parameters:
+        self (ScoringRecord): the self object.
+        golf_round (Score): the new round, not yet added to the session.
+
+        Returns:
+        The player's new handicap index, or None, if a 9 hole round is waiting for another.
+        """
+        golf_round = self.eighteenHoleRound(golf_round)
+        self.player.bump_version()
+        if golf_round is None:
+            db.session.commit()     # Save the 9 hole round waiting for another.
+            user_cache.invalidate(self.player.id)
+            return None
+
+        latest = self.window.latest()
+        backdated = latest is not None and golf_round.played < latest.played
+        if not backdated:
+            # Only the handicap indices within one year of the new round are needed.
+            # Used when the low handicap index must be replaced with the lowest from the preceding year.
+            self.timeline = IndexTimeline.load(history_query(self.player.id, start=golf_round.played - YEAR))
+
+        # Add the 18 hole round to the scoring record. The flush gives it the id that orders it among rounds on the same date.
         db.session.add(golf_round)
+        db.session.flush()
+        if backdated:
+            # A round played before the most recent one changes the history from its date on.
+            self.replayFrom(golf_round.played)
+        else:
+            history_index = self.applyRound(golf_round)
+            if history_index is not None:   # There won't be a handicap index for 1st two rounds.
+                # Add the new handicap index to the history.
+                db.session.add(IndexHistory(user_id=self.player.id, **self.historyEntry(golf_round, history_index)))
+            self.player.handicap_index = self.handicap_index
+            if self.window.rounds_played >= 20:
+                # Update the user's low handicap index and date.
+                self.player.low_handicap_index = self.low_handicap_index
+                self.player.low_handicap_index_date = self.low_handicap_index_date
+        refresh_conditions([(golf_round.course, golf_round.played)])    # The day's playing conditions, to be adjusted.
+
         db.session.commit()
-        self.rounds.append(golf_round)
+        snapshots.invalidate(self.player.id)    # The cached handicap is now out of date.
+        fragments.invalidate(self.player.id)
+        user_cache.invalidate(self.player.id)
+        return self.handicap_index
+
+    @metrics.timed
+    def applyRound(self, golf_round) -> float | None:
+        """
+        Re-evaluate the record in memory for a round played no earlier than any round already in it.
+        self.timeline must hold the index history up to the round, at least for the year before it.
+
+        Parameters:
+        self (ScoringRecord): the self object.
+        golf_round: the 18 hole round, a Round or a Score, with id, played and score_differential.
+
+        Returns:
+        The handicap index to record in the index history, or
+        None, if there is no handicap index yet (< 3 rounds).
+        self.handicap_index is left as the index after any exceptional score reduction,
+        and the low handicap index and its date are re-evaluated.
+        """
+        self.window.add(Round(golf_round.played, golf_round.id, golf_round.score_differential))
         # Calculate the new Handicap Index
         self.handicap_index = self.handicapIndex()
-        # Add the new (date, handicap index) pair to the remembered handicaps list.
-        # Used when the low handicap index must be replaced with the lowest from the preceding year.
-        if self.handicap_index:   # There won't be a handicap index for 1st two rounds.
-            # Add the new handicap index to the history.
-            db.session.add(IndexHistory(handicap_index=self.handicap_index, handicap_index_date=golf_round.played, user_id=self.player.id))
-            db.session.commit()
-            self.years_handicaps.append((golf_round.played, self.handicap_index))
-            # Only keep pairs within one year of the new round. There will always be at least the one being added.
-            self.years_handicaps = [(HI_date, HI) for (HI_date, HI) in self.years_handicaps \
-                                    if golf_round.played - HI_date <= timedelta(weeks=52)]
+        history_index = self.handicap_index
+        if self.handicap_index is not None:
+            # Add the new handicap index to the timeline, as it will be to the index history.
+            self.timeline.append(golf_round.played, self.handicap_index)
 
         # When a score is added, the Low Handicap Index is re-evaluated following the Handicap Index calculation.
-        if len(self.rounds) >= 20:
-            time_between_round_and_lowHI = abs(golf_round.played - self.low_handicap_index_date)
-            if time_between_round_and_lowHI > timedelta(weeks=52):
-                # reset the low HI to the lowest in the preceding year.
-                self.low_handicap_index_date, self.low_handicap_index = \
-                    sorted(self.years_handicaps, key=lambda x:x[1])[0]      # Sort by HI and use the first one
-            # Check for exceptional score.
-            check_exceptional_round = round(golf_round.score_differential - self.handicap_index, 1)
-            if 7.0 <= check_exceptional_round <= 9.9:
-                self.handicap_index -= 1.0
-            elif check_exceptional_round >= 10:
-                self.handicap_index -= 2.0
-
-            if self.handicap_index < self.low_handicap_index:
-                # Reset the low handicap to the new one just computed.
-                self.low_handicap_index = self.handicap_index
-                self.low_handicap_index_date = golf_round.played
-
-            # Update the user's low handicap index and date.
+        if self.window.rounds_played >= 20:
+            self.handicap_index, self.low_handicap_index, self.low_handicap_index_date = \
+                reevaluate_low_index(golf_round.played, golf_round.score_differential, self.handicap_index,
+                                     self.low_handicap_index, self.low_handicap_index_date, self.timeline)
+
+        return history_index
+
+    def historyEntry(self, golf_round, history_index: float) -> dict:
+        """
+        Return the index history columns for a round just applied to the record.
+
+        The low handicap index is kept with the entry once there is one (20 rounds),
+        as the checkpoint from which a replay can start.
+        """
+        established = self.window.rounds_played >= 20
+        return dict(handicap_index=history_index, handicap_index_date=golf_round.played,
+                    low_handicap_index=self.low_handicap_index if established else None,
+                    low_handicap_index_date=self.low_handicap_index_date if established else None)
+
+    @metrics.timed
+    def replayFrom(self, from_date: date) -> float | None:
+        """
+        Rebuild the index history, low handicap index and handicap index from the rounds played on or after a date.
+
+        The record is restored to its state before the date, using the low handicap index checkpointed
+        with the last index history entry before it, and the later rounds are re-applied in played date order.
+        The whole history is replayed if there is no checkpoint to start from.
+        The changes, and a bump of the player's version, are added to the session; the caller commits them.
+
+        Parameters:
+        self (ScoringRecord): the self object.
+        from_date (date): the earliest played date affected by a change to the rounds.
+
+        Returns:
+        The player's new handicap index, or None, if there are not enough rounds (< 3).
+        """
+        # Start from the last round before the date so the replay re-applies at least one round
+        # (restoring any exceptional score reduction on it), if there is one.
+        from_date = db.session.scalar(select(func.max(Score.played))
+                                      .where(Score.user_id == self.player.id, Score.played < from_date)) or from_date
+        rounds_before = db.session.scalar(select(func.count()).select_from(Score)
+                                          .where(Score.user_id == self.player.id, Score.played < from_date))
+        checkpoint = db.session.execute(select(IndexHistory)
+                                        .where(IndexHistory.user_id == self.player.id,
+                                               IndexHistory.handicap_index_date < from_date)
+                                        .order_by(IndexHistory.handicap_index_date.desc(), IndexHistory.id.desc())
+                                        .limit(1)).scalar()
+        if rounds_before >= 20 and (checkpoint is None or checkpoint.low_handicap_index is None):
+            # The low handicap index before the date is not known, so replay everything.
+            return self.replayFrom(db.session.scalar(select(func.min(Score.played)).where(Score.user_id == self.player.id)))
+
+        self.window = RoundsWindow(self.recentRounds(WINDOW_SIZE, before=from_date), rounds_played=rounds_before)
+        if rounds_before >= 20:
+            self.low_handicap_index = checkpoint.low_handicap_index
+            self.low_handicap_index_date = checkpoint.low_handicap_index_date
+        self.timeline = IndexTimeline.load(history_query(self.player.id, start=from_date - YEAR,
+                                                         end=from_date - timedelta(days=1)))
+        self.handicap_index = None     # Until a round is re-applied.
+        replaced_history = delete(IndexHistory).where(IndexHistory.user_id == self.player.id)
+        if rounds_before:
+            replaced_history = replaced_history.where(IndexHistory.handicap_index_date >= from_date)
+        db.session.execute(replaced_history)    # All of it, when replaying from the first round.
+
+        # Re-apply the rounds a page at a time, so a long history is never held in memory at once.
+        replayed_rounds = select(Score.played, Score.id, Score.score_differential) \
+                              .where(Score.user_id == self.player.id, Score.played >= from_date) \
+                              .order_by(Score.played, Score.id).limit(REPLAY_PAGE_SIZE)
+        page = Rounds.load(replayed_rounds)
+        while page:
+            index_history = []
+            for golf_round in page:
+                history_index = self.applyRound(golf_round)
+                if history_index is not None:
+                    index_history.append(dict(user_id=self.player.id, **self.historyEntry(golf_round, history_index)))
+            if index_history:
+                db.session.execute(insert(IndexHistory), index_history)
+            last = page[-1]
+            # Later rounds only look back over the window and the year before them, so memory stays bounded.
+            self.window.trim()
+            self.timeline.trim(last.played - YEAR)
+            page = Rounds.load(replayed_rounds.where(tuple_(Score.played, Score.id) > (last.played, last.id)))
+
+        self.player.handicap_index = self.handicap_index
+        if self.window.rounds_played >= 20:
             self.player.low_handicap_index = self.low_handicap_index
             self.player.low_handicap_index_date = self.low_handicap_index_date
-            db.session.commit()    # Update the user's record.
-
+        self.player.bump_version()
         return self.handicap_index
 
-
+    @metrics.timed
     def handicapIndex(self) -> float:
         '''
         Calculate the handicap index from the scores stored in the record.
@@ -183,57 +707,22 @@ class ScoringRecord():
         None, if there were not enough rounds to compute a handicap index (< 3).
         '''
 
-        rounds_played = len(self.rounds)
+        rounds_played = self.window.rounds_played
 
         if rounds_played < 3:
             return None
         
-        N = rounds_played
-        adjustment = 0
-
-        if rounds_played < 6:
-            M = 1
-            adjustment = -2 if rounds_played == 3 else -1 if rounds_played == 4 else 0
-        elif rounds_played < 9:
-            M = 2
-            adjustment = -1 if rounds_played == 6 else 0
-        elif rounds_played < 20:
-            M = 3 if rounds_played < 12 else \
-                4 if rounds_played < 15 else \
-                5 if rounds_played < 17 else \
-                6 if rounds_played < 19 else \
-                7
-        else:
-            # rounds_played >= 20
-            N = 20  # Get the 20 most recent rounds.
-            M = 8   # Average of the lowest 8 rounds
-
-        sorted_rounds = sorted(self.rounds, key=lambda x: x.played, reverse=True)
-        most_recent = sorted_rounds[:N]
+        M, adjustment = counting_size(rounds_played)
 
         # Get the M best scoring differentials from the N most recent rounds.
-        sorted_rounds = sorted(most_recent, key=lambda x: x.score_differential)
-        best_differentials = sorted_rounds[:M]
+        best_differentials = self.window.lowest(M)
 
         # Sum the M best scoring differentials and divide by M for the average.
-        self.handicap_index = round(sum(round.score_differential for round in best_differentials) / M, 1)
+        average = sum(round.score_differential for round in best_differentials) / M
         # The Low Handicap Index is established once there are 20 rounds in the record.
         if rounds_played == 20:
-            self.low_handicap_index = self.handicap_index
-            self.low_handicap_index_date = most_recent[0].played
-        if rounds_played >= 20:
-            # Apply the caps.
-            if self.handicap_index - self.low_handicap_index > 3:
-                restricted_amount = (self.handicap_index - (self.low_handicap_index + 3)) / 2   # 50% of additional amount
-                self.handicap_index += restricted_amount
-            if self.handicap_index - self.low_handicap_index > 5:
-                self.handicap_index = self.low_handicap_index + 5
-        else:
-            # Apply the adjustment.
-            self.handicap_index += adjustment
-
-        # Maximum handicap.
-        if self.handicap_index > 54:
-            self.handicap_index = 54
+            self.low_handicap_index = round(average, 1)
+            self.low_handicap_index_date = self.window.latest().played
+        self.handicap_index = adjusted_index(average, rounds_played, adjustment, self.low_handicap_index)
 
         return self.handicap_index
\ No newline at end of file
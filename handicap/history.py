@@ -0,0 +1,159 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from sqlalchemy import select
+from handicap import db
+from handicap.models import User, IndexHistory
+
+YEAR = timedelta(weeks=52)   # The span over which the low handicap index is taken.
+
+class IndexTimeline():
+    """
+    A player's handicap index history for point in time and range lookups.
+
+    Entries are held in date order, in arrays of date ordinals and handicap indices, with a sparse table
+    of the positions of range minima: level k holds, for each position, the position of the lowest index
+    in the 2**k entries starting there. Each entry completes one table entry per level, O(log n), which is
+    done when a range is next looked up, so appending costs O(1) when ranges are seldom wanted (as when
+    replaying a history). The index on a date is found by bisection in O(log n), and the lowest index over
+    any date range in O(log n) for the bisection and O(1) for the minimum. Entries on the same date are kept in
+    the order they were appended (the index history's id order), the last being the one in force that day.
+    """
+
+    __slots__ = ('_days', '_indexes', '_minima', '_tabled')
+
+    def __init__(self, history=()) -> None:
+        self._days = array('i')
+        self._indexes = array('d')
+        self._minima = []   # Levels 1 and up; level 0 is each position itself.
+        self._tabled = 0    # The entries added to the sparse table so far.
+        for day, handicap_index in history:
+            self.append(day, handicap_index)
+
+    @classmethod
+    def load(cls, query) -> 'IndexTimeline':
+        """Load a timeline from a query of (handicap index date, handicap index) rows, in date then id order."""
+        return cls(db.session.execute(query).tuples())
+
+    def append(self, day: date, handicap_index: float) -> None:
+        """Add an entry dated no earlier than the last one."""
+        ordinal = day.toordinal()
+        if self._days and ordinal < self._days[-1]:
+            raise ValueError(f'{day} is before the last entry in the timeline.')
+        self._days.append(ordinal)
+        self._indexes.append(handicap_index)
+
+    def trim(self, start: date) -> None:
+        """Forget the entries dated before a date, e.g. those a replay has left more than a year behind."""
+        dropped = bisect_left(self._days, start.toordinal())
+        if dropped:
+            del self._days[:dropped]
+            del self._indexes[:dropped]
+            self._minima, self._tabled = [], 0     # Positions have moved; rebuilt at the next lookup.
+
+    def _table(self) -> None:
+        """Add the entries appended since the last lookup to the sparse table, a level at a time."""
+        indexes, minima = self._indexes, self._minima
+        count = len(indexes)
+        below, level, width = range(count), 1, 2
+        while width <= count:
+            if level > len(minima):
+                minima.append(array('i'))
+            table = minima[level - 1]
+            # Each new entry combines two of the level below, half the width apart, preferring the earlier on a tie.
+            first, last, half = len(table), count - width + 1, width // 2
+            table.extend(left if indexes[left] <= indexes[right] else right
+                         for left, right in zip(below[first:last], below[first + half:last + half]))
+            below, level, width = table, level + 1, width * 2
+        self._tabled = count
+
+    def __len__(self) -> int:
+        return len(self._days)
+
+    def __iter__(self):
+        for ordinal, handicap_index in zip(self._days, self._indexes):
+            yield date.fromordinal(ordinal), handicap_index
+
+    def at(self, day: date) -> float | None:
+        """Return the handicap index in force on a date, or None if there was none yet."""
+        position = bisect_right(self._days, day.toordinal()) - 1
+        return self._indexes[position] if position >= 0 else None
+
+    def lowest(self, start: date, end: date) -> tuple[date, float] | None:
+        """
+        Return the lowest handicap index dated within a range, and its date.
+
+        Parameters:
+        start (date), end (date): the first and last dates of the range, inclusive.
+
+        Returns:
+        A (date, handicap index) pair, the earliest if the lowest index was reached more than once,
+        or None if there are no entries in the range.
+        """
+        first = bisect_left(self._days, start.toordinal())
+        last = bisect_right(self._days, end.toordinal()) - 1
+        if first > last:
+            return None
+        if self._tabled < len(self._indexes):
+            self._table()
+        level = (last - first + 1).bit_length() - 1
+        position = self._lower(self._lowest_at(level, first), self._lowest_at(level, last - (1 << level) + 1))
+        return date.fromordinal(self._days[position]), self._indexes[position]
+
+    def _lowest_at(self, level: int, start: int) -> int:
+        return start if level == 0 else self._minima[level - 1][start]
+
+    def _lower(self, left: int, right: int) -> int:
+        """Return the position of the lower index, preferring the earlier (left) one on a tie."""
+        return left if self._indexes[left] <= self._indexes[right] else right
+
+def history_query(player_id: int, start: date=None, end: date=None):
+    """Return the query of a player's (date, handicap index) history between two dates (inclusive), for IndexTimeline.load()."""
+    query = select(IndexHistory.handicap_index_date, IndexHistory.handicap_index) \
+                .where(IndexHistory.user_id == player_id) \
+                .order_by(IndexHistory.handicap_index_date, IndexHistory.id)
+    if start is not None:
+        query = query.where(IndexHistory.handicap_index_date >= start)
+    if end is not None:
+        query = query.where(IndexHistory.handicap_index_date <= end)
+    return query
+
+def index_in_force(day: date):
+    """
+    Return a scalar subquery, correlated with User, of the player's handicap index on a date.
+    It is a seek on the (user_id, date) index of the history, so O(log n) per player.
+    """
+    return select(IndexHistory.handicap_index) \
+               .where(IndexHistory.user_id == User.id, IndexHistory.handicap_index_date <= day) \
+               .order_by(IndexHistory.handicap_index_date.desc(), IndexHistory.id.desc()) \
+               .limit(1).correlate(User).scalar_subquery()
+
+def index_on(player_ids: list[int], day: date) -> dict[int, float | None]:
+    """
+    Return the handicap index each of a field of players had on a date, with one query.
+
+    Returns:
+    A dict of player id: handicap index, or None for a player with no index by the date.
+    Ids of players that don't exist are left out.
+    """
+    return dict(db.session.execute(select(User.id, index_in_force(day)).where(User.id.in_(player_ids))).tuples().all())
+
+def lowest_between(player_ids: list[int], start: date, end: date) -> dict[int, tuple[date, float] | None]:
+    """
+    Return the lowest handicap index each of a field of players had between two dates (inclusive), with its date.
+
+    The players' histories over the range are read in one query into timelines, which answer the range minimum.
+
+    Returns:
+    A dict of player id: (date, handicap index), or None for a player with no index in the range.
+    Ids of players that don't exist are left out.
+    """
+    timelines = {player_id: IndexTimeline() for player_id in
+                 db.session.scalars(select(User.id).where(User.id.in_(player_ids)))}
+    rows = db.session.execute(select(IndexHistory.user_id, IndexHistory.handicap_index_date, IndexHistory.handicap_index)
+                              .where(IndexHistory.user_id.in_(timelines), IndexHistory.handicap_index_date >= start,
+                                     IndexHistory.handicap_index_date <= end)
+                              .order_by(IndexHistory.user_id, IndexHistory.handicap_index_date, IndexHistory.id))
+    for player_id, day, handicap_index in rows:
+        timelines[player_id].append(day, handicap_index)
+    return {player_id: timeline.lowest(start, end) for player_id, timeline in timelines.items()}
@@ -0,0 +1,355 @@
+import json
+import secrets
+from collections import OrderedDict, deque, namedtuple
+from datetime import date, timedelta
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
+from sortedcontainers import SortedKeyList
+from sqlalchemy import Integer, cast, event, func, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+MAX_INDEX = 54.0    # The index of a player who has none yet.
+
+# A player's place on a leaderboard. Net is to par: the gross score less the course handicap and par.
+Standing = namedtuple('Standing', ['net', 'gross', 'player_id', 'name', 'handicap_index', 'score_id'])
+# A round of an event, as read from the database.
+EventRound = namedtuple('EventRound', ['score_id', 'player_id', 'name', 'gross', 'course_rating', 'course_slope'])
+
+def round_checksum(gross: int, course_rating: float, course_slope: int) -> int:
+    """Return a number that changes with any edit to the scoring columns of a round, as event_checksum() sums it."""
+    return gross * 1_000_000 + course_slope * 10_000 + int(course_rating * 10 + 0.5)
+
+def event_checksum(score):
+    """The SQL sum of round_checksum() over an event's rounds, for the Score model."""
+    return func.coalesce(func.sum(score.gross_adjusted_score * 1_000_000 + score.course_slope * 10_000
+                                  + cast(score.course_rating * 10 + 0.5, Integer)), 0)
+
+def net_to_par(gross: int, handicap_index: float, course_rating: float, course_slope: int) -> int:
+    """
+    Return a round's net score to par, at full allowance.
+
+    Net to par = gross - Course Handicap - par, where Course Handicap = round(index x slope / 113 + rating - par).
+    As par is a whole number it comes out of the rounding, so net to par = gross - round(index x slope / 113 + rating),
+    and the par of the course, which rounds don't record, isn't needed.
+    """
+    return gross - int((round(handicap_index * course_slope / 113 + course_rating, 6) + 0.5) // 1)
+
+class Subscriber():
+    """A connection watching a leaderboard, with a bounded queue of the (sequence, message) events it hasn't sent yet."""
+
+    def __init__(self, queue_size: int) -> None:
+        self.queue = Queue(maxsize=queue_size)
+
+    def offer(self, sequence: int, message: str) -> None:
+        """
+        Queue an event. If the connection has fallen too far behind, its queued events are dropped
+        for a marker telling it to send a snapshot of the whole board instead.
+        """
+        try:
+            self.queue.put_nowait((sequence, message))
+        except Full:
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+            self.queue.put_nowait((None, None))
+
+class Leaderboard():
+    """
+    The live net score ranking of an event: the rounds played on a course on a date.
+
+    Standings are kept in a sorted list by net score, so a round posted or changed costs O(log n).
+    Each change is published as a numbered server-sent event to the connections watching the board,
+    and the last LEADERBOARD_HISTORY events are kept, so a connection that drops can resume from the last
+    event id it received. Event ids are '<epoch>.<sequence>', the epoch changing when the board is rebuilt
+    (e.g. after a restart), so an id from an earlier board gets a snapshot rather than the wrong events.
+    The board is refreshed from the database by one thread while anyone is watching, every
+    LEADERBOARD_POLL_SECONDS, or at once when a round for the event is committed in this process.
+
+    Only the first refresh reads the whole event. Later ones read the rounds added since (their ids are
+    above the last one seen) and those edited or deleted by this process's commits, and check a count and
+    checksum of the event's rounds, one aggregate row, against the board's own; a round edited or deleted
+    by another process makes them differ, and only then is the event read again.
+    """
+
+    def __init__(self, leaderboards, course: str, played: date) -> None:
+        self.leaderboards = leaderboards
+        self.course = course
+        self.played = played
+        self.epoch = secrets.token_hex(4)
+        self.sequence = 0
+        self._lock = Lock()         # Guards the standings, events and subscribers.
+        self._refresh_lock = Lock()
+        self._standings = {}        # player id: Standing
+        self._rounds = {}           # score id: EventRound, the event's rounds.
+        self._player_rounds = {}    # player id: the score ids of the player's rounds.
+        self._last_id = 0           # The highest score id read.
+        self._fingerprint = (0, 0, 0)   # The count, sum of ids and sum of checksums of the rounds.
+        self._changed = set()       # Score ids edited or deleted by this process's commits since the last refresh.
+        self._ranking = SortedKeyList(key=lambda standing: (standing.net, standing.gross, standing.player_id))
+        self._indexes = {}          # player id: handicap index on the day, fixed for the event.
+        self._history = deque(maxlen=leaderboards.history_size)
+        self._subscribers = set()
+        self._loaded = False
+        self._wake = Event()
+        self._poller = None
+
+    def standings(self) -> list[tuple[int, Standing]]:
+        """Return the (position, standing) of each player, in order."""
+        with self._lock:
+            return [(self.position(standing), standing) for standing in self._ranking]
+
+    def position(self, standing: Standing) -> int:
+        """Return a standing's position, shared with those on the same net score. Call with the lock held."""
+        return self._ranking.bisect_key_left((standing.net,)) + 1
+
+    def refresh(self) -> None:
+        """Read the changes to the event's rounds and publish the changes to the standings."""
+        from handicap import db
+        from handicap.models import User, Score
+        from handicap.history import index_on
+        in_event = (Score.played == self.played, Score.course == self.course, Score.holes == 18)
+        rounds = select(Score.id, Score.user_id, User.name, Score.gross_adjusted_score, Score.course_rating,
+                        Score.course_slope).join(User, User.id == Score.user_id).where(*in_event)
+        fingerprint = select(func.count(), func.coalesce(func.sum(Score.id), 0), event_checksum(Score)) \
+                          .join(User, User.id == Score.user_id).where(*in_event)
+        with self._refresh_lock, self.leaderboards.app.app_context():
+            with self._lock:
+                changed, self._changed = self._changed, set()
+            players = set()
+            if self._loaded:
+                rows = db.session.execute(rounds.where(Score.id > self._last_id)).tuples().all()
+                if changed:
+                    rows += db.session.execute(rounds.where(Score.id.in_(changed))).tuples().all()
+                players |= self._update_rounds(rows, changed - {row[0] for row in rows})
+                unchanged = tuple(db.session.execute(fingerprint).one()) == self._fingerprint
+            if not self._loaded or not unchanged:    # Changed elsewhere: read the whole event.
+                rows = db.session.execute(rounds).tuples().all()
+                players |= self._update_rounds(rows, self._rounds.keys() - {row[0] for row in rows})
+            new_players = players - self._indexes.keys()
+            if new_players:
+                # The index a player brought to the event is the one in force the day before.
+                self._indexes.update(index_on(list(new_players), self.played - timedelta(days=1)))
+            db.session.remove()
+        latest = {}
+        for player_id in players:
+            score_ids = self._player_rounds.get(player_id)
+            if not score_ids:
+                latest[player_id] = None
+                continue
+            golf_round = self._rounds[max(score_ids)]   # A player's last round counts.
+            index = self._indexes.get(player_id)
+            index = MAX_INDEX if index is None else round(index, 1)
+            latest[player_id] = Standing(net_to_par(golf_round.gross, index, golf_round.course_rating, golf_round.course_slope),
+                                         golf_round.gross, player_id, golf_round.name, index, golf_round.score_id)
+        self.apply(latest)
+
+    def _update_rounds(self, rows: list[tuple], removed: set[int]) -> set[int]:
+        """
+        Bring the board's rounds up to date, keeping their fingerprint, with the rows read and the ids of rounds no longer in the event.
+
+        Returns:
+        The ids of the players whose rounds changed.
+        """
+        count, id_sum, checksum = self._fingerprint
+        players = set()
+        for golf_round in [self._rounds[score_id] for score_id in removed if score_id in self._rounds] + \
+                          [self._rounds[row[0]] for row in rows if row[0] in self._rounds]:
+            if self._rounds.pop(golf_round.score_id, None) is None:
+                continue    # Read twice, as new and as changed.
+            self._player_rounds[golf_round.player_id].discard(golf_round.score_id)
+            count, id_sum = count - 1, id_sum - golf_round.score_id
+            checksum -= round_checksum(golf_round.gross, golf_round.course_rating, golf_round.course_slope)
+            players.add(golf_round.player_id)
+        for row in rows:
+            golf_round = EventRound(*row)
+            if golf_round.score_id in self._rounds:
+                continue
+            self._rounds[golf_round.score_id] = golf_round
+            self._player_rounds.setdefault(golf_round.player_id, set()).add(golf_round.score_id)
+            self._last_id = max(self._last_id, golf_round.score_id)
+            count, id_sum = count + 1, id_sum + golf_round.score_id
+            checksum += round_checksum(golf_round.gross, golf_round.course_rating, golf_round.course_slope)
+            players.add(golf_round.player_id)
+        self._fingerprint = (count, id_sum, checksum)
+        return players
+
+    def apply(self, latest: dict) -> None:
+        """
+        Bring the standings of the players given to the latest (None: no longer on the board),
+        publishing an event for each player added, changed or removed.
+        """
+        with self._lock:
+            for player_id, standing in latest.items():
+                current = self._standings.get(player_id)
+                if current == standing:
+                    continue
+                if current is not None:
+                    self._ranking.remove(current)
+                if standing is None:
+                    del self._standings[player_id]
+                    self._publish('remove', dict(player_id=player_id))
+                    continue
+                self._standings[player_id] = standing
+                self._ranking.add(standing)
+                self._publish('standing', dict(standing._asdict(), position=self.position(standing)))
+            self._loaded = True
+
+    def _publish(self, kind: str, data: dict) -> None:
+        """Number an event, keep it for resuming, and offer it to each subscriber. Call with the lock held."""
+        self.sequence += 1
+        message = f'id: {self.epoch}.{self.sequence}\nevent: {kind}\ndata: {json.dumps(data)}\n\n'
+        self._history.append((self.sequence, message))
+        for subscriber in self._subscribers:
+            subscriber.offer(self.sequence, message)
+
+    def _snapshot(self) -> tuple[int, str]:
+        """Return the whole board as an event numbered with the last sequence. Call with the lock held."""
+        data = dict(course=self.course, played=self.played.isoformat(),
+                    standings=[dict(standing._asdict(), position=self.position(standing)) for standing in self._ranking])
+        return self.sequence, f'id: {self.epoch}.{self.sequence}\nevent: snapshot\ndata: {json.dumps(data)}\n\n'
+
+    def subscribe(self, last_event_id: str=None) -> Subscriber:
+        """
+        Start watching the board. The subscriber's queue starts with the events after last_event_id,
+        if they are still kept, or otherwise with a snapshot of the board.
+        """
+        if not self._loaded:
+            self.refresh()
+        subscriber = Subscriber(self.leaderboards.queue_size)
+        with self._lock:
+            epoch, _, sequence = (last_event_id or '').partition('.')
+            oldest = self._history[0][0] if self._history else self.sequence + 1
+            if epoch == self.epoch and sequence.isdigit() and oldest - 1 <= int(sequence) <= self.sequence \
+                    and self.sequence - int(sequence) <= self.leaderboards.queue_size:
+                backlog = [event for event in self._history if event[0] > int(sequence)]
+            else:
+                backlog = [self._snapshot()]
+            for sequence_number, message in backlog:
+                subscriber.offer(sequence_number, message)
+            self._subscribers.add(subscriber)
+            if self._poller is None:
+                self._poller = Thread(target=self._poll, name=f'leaderboard-{self.played}', daemon=True)
+                self._poller.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def watchers(self) -> int:
+        return len(self._subscribers)
+
+    def wake(self, score_ids=()) -> None:
+        """Refresh the board now, rather than at the next poll, re-reading the rounds with these ids."""
+        with self._lock:
+            self._changed.update(score_ids)
+        self._wake.set()
+
+    def _poll(self) -> None:
+        while True:
+            self._wake.wait(self.leaderboards.poll_seconds)
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    self._poller = None     # Nobody is watching; the next subscriber starts another.
+                    return
+            try:
+                self.refresh()
+            except Exception:
+                self.leaderboards.app.logger.exception(f'The leaderboard for {self.course} on {self.played} '
+                                                       'could not be refreshed.')
+
+    def stream(self, subscriber: Subscriber):
+        """Yield the server-sent events for a subscriber, with keep-alive comments while the board is quiet."""
+        sent = -1
+        try:
+            yield f'retry: {self.leaderboards.retry_ms}\n\n'
+            while True:
+                try:
+                    sequence, message = subscriber.queue.get(timeout=self.leaderboards.keepalive_seconds)
+                except Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if sequence is None:
+                    with self._lock:    # The subscriber fell behind, so it is sent the whole board.
+                        sequence, message = self._snapshot()
+                elif sequence <= sent:
+                    continue    # Already covered by a snapshot.
+                sent = sequence
+                yield message
+        finally:
+            self.unsubscribe(subscriber)
+
+class Leaderboards():
+    """
+    The live leaderboards of the events being watched in this process, kept for the LEADERBOARDS most
+    recently watched events. Rounds committed through the ORM wake the boards of their events at once;
+    rounds written by other processes, or in bulk, appear at the next poll.
+    """
+
+    def __init__(self, app=None) -> None:
+        self.app = None
+        self.maxsize = 32
+        self.poll_seconds = 2.0
+        self.queue_size = 100
+        self.history_size = 1000
+        self.keepalive_seconds = 15.0
+        self.retry_ms = 3000
+        self._boards = OrderedDict()
+        self._lock = Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.app = app
+        self.maxsize = app.config.get('LEADERBOARDS', self.maxsize)
+        self.poll_seconds = app.config.get('LEADERBOARD_POLL_SECONDS', self.poll_seconds)
+        self.queue_size = app.config.get('LEADERBOARD_QUEUE_SIZE', self.queue_size)
+        self.history_size = app.config.get('LEADERBOARD_HISTORY', self.history_size)
+        self.keepalive_seconds = app.config.get('LEADERBOARD_KEEPALIVE_SECONDS', self.keepalive_seconds)
+        with self._lock:
+            self._boards.clear()
+        if not self._listening:
+            from handicap.models import Score
+            for change in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(Score, change, self._score_changed)
+            event.listen(Session, 'after_commit', self._committed)
+            event.listen(Session, 'after_rollback', lambda session: session.info.pop('leaderboard_events', None))
+            self._listening = True
+
+    def get(self, course: str, played: date) -> Leaderboard:
+        """Return the leaderboard of an event, making it if it isn't kept."""
+        with self._lock:
+            board = self._boards.get((course, played))
+            if board is None:
+                board = self._boards[course, played] = Leaderboard(self, course, played)
+                # Forget the least recently watched boards nobody is watching now.
+                for key in [key for key, kept in self._boards.items() if not kept.watchers]:
+                    if len(self._boards) <= self.maxsize:
+                        break
+                    if key != (course, played):
+                        del self._boards[key]
+            self._boards.move_to_end((course, played))
+            return board
+
+    def _score_changed(self, mapper, connection, score) -> None:
+        session = object_session(score)
+        if session is None:
+            return
+        events = session.info.setdefault('leaderboard_events', {})  # (course, played): the ids of its rounds changed.
+        events.setdefault((score.course, score.played), set()).add(score.id)
+        state = inspect(score)
+        # An edit may move a round from one event to another.
+        for course in state.attrs.course.history.deleted or (score.course,):
+            for played in state.attrs.played.history.deleted or (score.played,):
+                events.setdefault((course, played), set()).add(score.id)
+
+    def _committed(self, session) -> None:
+        for key, score_ids in session.info.pop('leaderboard_events', {}).items():
+            board = self._boards.get(key)
+            if board is not None:
+                board.wake(score_ids)
@@ -0,0 +1,155 @@
+import atexit
+import os
+import smtplib
+import time
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+
+class MailQueue():
+    """
+    Send mail in the background, so a request returns as soon as its message is queued.
+
+    Worker threads take messages off a bounded queue in batches and send them over an SMTP
+    connection that is kept open while there is mail to send, and closed once the queue has been
+    idle for MAIL_IDLE_SECONDS. A message that fails is retried on a new connection, backing off
+    exponentially, up to MAIL_RETRIES times before it is logged and dropped; one that fails otherwise,
+    e.g. with a header that can't be encoded, is logged and dropped at once.
+    The queue is drained when the process exits. With MAIL_WORKERS = 0 mail is sent in the request.
+    Flask-Mail is imported when the first message is sent, as most workers never send one.
+    """
+
+    def __init__(self, app=None) -> None:
+        self.app = None
+        self.maxsize = 100
+        self.workers = 2
+        self.batch_size = 20
+        self.retries = 3
+        self.backoff = 1.0
+        self.idle_seconds = 5.0
+        self._lock = Lock()
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._mail = None
+        self._mail_lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.app = app
+        self.maxsize = app.config.get('MAIL_QUEUE_SIZE', self.maxsize)
+        self.workers = app.config.get('MAIL_WORKERS', self.workers)
+        self.batch_size = app.config.get('MAIL_BATCH_SIZE', self.batch_size)
+        self.retries = app.config.get('MAIL_RETRIES', self.retries)
+        self.backoff = app.config.get('MAIL_RETRY_BACKOFF', self.backoff)
+        self.idle_seconds = app.config.get('MAIL_IDLE_SECONDS', self.idle_seconds)
+        atexit.register(self.shutdown)
+
+    def send(self, message) -> bool:
+        """
+        Queue a message to be sent.
+
+        Returns:
+        True if the message was queued (or sent, without workers), or
+        False if the queue is full.
+        """
+        if not self.workers:
+            self.mail().send(message)
+            return True
+        self._start()
+        try:
+            self._queue.put_nowait(message)
+        except Full:
+            return False
+        return True
+
+    def mail(self):
+        """Return the Flask-Mail extension, initialising it with the app on first use."""
+        with self._mail_lock:
+            if self._mail is None:
+                from flask_mail import Mail
+                self._mail = Mail(self.app)
+        return self._mail
+
+    def _start(self) -> None:
+        """Start the workers on first use, and again in a forked worker process, which doesn't inherit threads."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue(maxsize=self.maxsize)
+            self._threads = [Thread(target=self._work, name=f'mail-{number}', daemon=True)
+                             for number in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def shutdown(self, timeout: float=30) -> None:
+        """Send the mail still queued, then stop the workers."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for _ in self._threads:
+                self._queue.put(None)   # Each worker stops when it reaches one, after the mail queued before it.
+            threads, self._threads, self._pid = self._threads, [], None
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def _work(self) -> None:
+        mail = self.mail()
+        with self.app.app_context():
+            connection = None
+            stopping = False
+            while not stopping:
+                try:
+                    message = self._queue.get(timeout=self.idle_seconds if connection else None)
+                except Empty:
+                    connection = self._close(connection)    # Idle, so release the SMTP connection.
+                    continue
+                # Take what else is waiting, up to a batch, stopping at a shutdown marker.
+                batch = []
+                while message is not None:
+                    batch.append(message)
+                    if len(batch) == self.batch_size:
+                        break
+                    try:
+                        message = self._queue.get_nowait()
+                    except Empty:
+                        break
+                else:
+                    stopping = True
+                for message in batch:
+                    try:
+                        connection = self._deliver(mail, connection, message)
+                    except Exception:
+                        # A message that can't be sent at all (e.g. a header it can't encode) is dropped,
+                        # so the worker carries on with the rest of the queue.
+                        self.app.logger.exception(f'Mail to {", ".join(message.recipients)} could not be sent')
+                        connection = self._close(connection)
+            self._close(connection)
+
+    def _deliver(self, mail, connection, message):
+        """Send a message, reconnecting and retrying with backoff if it fails. Returns the connection to reuse."""
+        for attempt in range(self.retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+                connection.send(message)
+                return connection
+            except (smtplib.SMTPException, OSError) as error:
+                connection = self._close(connection)
+                if attempt == self.retries:
+                    self.app.logger.error(f'Mail to {", ".join(message.recipients)} could not be sent: {error}')
+                    return None
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _close(self, connection) -> None:
+        """Close a connection, if there is one. Returns None, to clear the caller's connection."""
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass    # The connection has already gone, or was left unusable.
+        return None
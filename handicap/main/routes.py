@@ -1,39 +1,30 @@
 from flask import render_template, Blueprint
 from flask_login import current_user
 from handicap.handicap import ScoringRecord
+from handicap.caching import conditional
 
 main = Blueprint('main', __name__)
 
+def handicap_index() -> float | None:
+    """Return the logged in player's handicap index, rounded for display in the page header."""
+    current_index = ScoringRecord.snapshot(current_user).handicap_index
+    return round(current_index, 1) if current_index else None
+
+def counting_rounds() -> list:
+    """Return the logged in player's counting rounds, with their played dates formatted for display."""
+    return [(index, score._replace(played=score.played.strftime('%d-%m-%Y')), window)
+            for index, score, window in ScoringRecord.snapshot(current_user).counting_rounds]
+
+main.add_app_template_global(handicap_index)
+main.add_app_template_global(counting_rounds)
+
+# The header and the counting rounds are rendered from the snapshot only when their cached fragments are out of date.
 @main.route("/")
 @main.route("/home")
+@conditional
 def home():
-    if current_user.is_authenticated:
-        player = current_user.name
-        player_record = ScoringRecord(current_user.id)
-        current_index = player_record.handicapIndex()
-        hi = round(current_index, 1) if current_index else None
-        scores = player_record.countingRounds()
-        del player_record
-        # Adjust played dates format for display.  
-        for _, score, _ in scores:
-            score.played = score.played.strftime('%d-%m-%Y')
-    else:
-        player = ""
-        hi = None
-        scores = []
-    return render_template('home.html', player=player, hi=hi,
-                           login=current_user.is_authenticated,
-                           len_scores=len(scores), scores=scores)
+    return render_template('home.html', login=current_user.is_authenticated)
 
 @main.route("/about")
 def about():
-    if current_user.is_authenticated:
-        player = current_user.name
-        player_record = ScoringRecord(current_user.id)
-        current_index = player_record.handicapIndex()
-        del player_record
-        hi = round(current_index, 1) if current_index else None
-    else:
-        player = ""
-        hi = None
-    return render_template('about.html', title='About', player=player, hi=hi)
\ No newline at end of file
+    return render_template('about.html', title='About')
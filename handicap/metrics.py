@@ -0,0 +1,179 @@
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+# Request latency histogram bucket bounds, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_SQL_LIMIT = 50     # Statements kept for a slow request's log entry.
+
+class RequestStats():
+    """What one request has spent, kept on flask.g while it runs."""
+
+    __slots__ = ('start', 'statements', 'sql_seconds', 'sql')
+
+    def __init__(self, capture_sql: bool) -> None:
+        self.start = perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.sql = [] if capture_sql else None
+
+class Metrics():
+    """
+    Request, SQL and handicap calculation metrics for the app, served in Prometheus text format on /metrics.
+
+    Each endpoint has a latency histogram, a count of requests by status, and the number of SQL statements
+    and time spent in the database, taken from the engine's cursor events. Functions decorated with timed()
+    (the ScoringRecord methods) count their calls and time, including any timed calls they make.
+    Requests slower than SLOW_REQUEST_SECONDS are logged with the SQL they ran, and the time create_app
+    spent in each start up phase is reported too.
+    Metrics are held in the worker process, so each worker reports its own.
+    """
+
+    def __init__(self, app=None) -> None:
+        self.enabled = True
+        self.slow_request_seconds = None
+        self.token = None
+        self._lock = Lock()
+        self._latency = defaultdict(lambda: [0] * (len(BUCKETS) + 1))   # (endpoint, method): bucket counts.
+        self._latency_sum = defaultdict(float)
+        self._requests = defaultdict(int)      # (endpoint, method, status): count.
+        self._statements = defaultdict(int)    # endpoint: count.
+        self._sql_seconds = defaultdict(float)
+        self._calls = defaultdict(int)         # function: count.
+        self._call_seconds = defaultdict(float)
+        self.boot_seconds = {}                 # Start up phase: seconds.
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        from handicap import db
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        self.slow_request_seconds = app.config.get('SLOW_REQUEST_SECONDS', self.slow_request_seconds)
+        self.token = app.config.get('METRICS_TOKEN', self.token)
+        if not self.enabled:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(db.engine, 'handle_error', self._handle_error)
+
+    def record_boot(self, boot_seconds: dict) -> None:
+        """Record the seconds spent in each phase of the app's start up."""
+        self.boot_seconds = dict(boot_seconds)
+
+    def timed(self, function):
+        """Decorate a function to count its calls and the time spent in it."""
+        name = function.__qualname__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                with self._lock:
+                    self._calls[name] += 1
+                    self._call_seconds[name] += elapsed
+        return wrapper
+
+    def _before_request(self) -> None:
+        g.request_stats = RequestStats(capture_sql=self.slow_request_seconds is not None)
+
+    def _after_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        elapsed = perf_counter() - stats.start
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            self._latency[endpoint, request.method][bisect_left(BUCKETS, elapsed)] += 1
+            self._latency_sum[endpoint, request.method] += elapsed
+            self._requests[endpoint, request.method, response.status_code] += 1
+            self._statements[endpoint] += stats.statements
+            self._sql_seconds[endpoint] += stats.sql_seconds
+        if self.slow_request_seconds is not None and elapsed >= self.slow_request_seconds:
+            sql = '\n'.join(f'  {seconds * 1000:.1f} ms  {statement}' for seconds, statement in stats.sql)
+            current_app.logger.warning(f'Slow request: {request.method} {request.path} ({endpoint}) '
+                                       f'{response.status_code} took {elapsed * 1000:.0f} ms, '
+                                       f'{stats.statements} SQL statements in {stats.sql_seconds * 1000:.0f} ms\n{sql}')
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        self._record_statement(statement, perf_counter() - conn.info['query_start'].pop())
+
+    def _handle_error(self, context) -> None:
+        # A statement that raised gets no after_cursor_execute: its start is popped here, so a pooled
+        # connection's list doesn't grow, and it is counted like any other.
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:  # Empty if it failed before it was sent.
+            self._record_statement(context.statement or '', perf_counter() - starts.pop())
+
+    def _record_statement(self, statement: str, elapsed: float) -> None:
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += elapsed
+            if stats.sql is not None and len(stats.sql) < SLOW_SQL_LIMIT:
+                stats.sql.append((elapsed, ' '.join(statement.split())))
+
+    def _metrics_view(self):
+        if self.token and request.headers.get('Authorization') != f'Bearer {self.token}':
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self) -> str:
+        """Return the metrics in Prometheus text exposition format."""
+        with self._lock:
+            latency = {key: list(counts) for key, counts in self._latency.items()}
+            latency_sum = dict(self._latency_sum)
+            requests = dict(self._requests)
+            statements = dict(self._statements)
+            sql_seconds = dict(self._sql_seconds)
+            calls = dict(self._calls)
+            call_seconds = dict(self._call_seconds)
+        lines = ['# HELP handicap_request_duration_seconds Request latency by endpoint.',
+                 '# TYPE handicap_request_duration_seconds histogram']
+        for (endpoint, method), counts in sorted(latency.items()):
+            labels = f'endpoint="{endpoint}",method="{method}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'handicap_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'handicap_request_duration_seconds_sum{{{labels}}} {latency_sum[endpoint, method]:.6f}')
+            lines.append(f'handicap_request_duration_seconds_count{{{labels}}} {cumulative}')
+        lines += ['# HELP handicap_requests_total Requests by endpoint and status.',
+                  '# TYPE handicap_requests_total counter']
+        lines += [f'handicap_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}'
+                  for (endpoint, method, status), count in sorted(requests.items())]
+        lines += ['# HELP handicap_sql_statements_total SQL statements executed by endpoint.',
+                  '# TYPE handicap_sql_statements_total counter']
+        lines += [f'handicap_sql_statements_total{{endpoint="{endpoint}"}} {count}'
+                  for endpoint, count in sorted(statements.items())]
+        lines += ['# HELP handicap_sql_seconds_total Time spent executing SQL by endpoint.',
+                  '# TYPE handicap_sql_seconds_total counter']
+        lines += [f'handicap_sql_seconds_total{{endpoint="{endpoint}"}} {seconds:.6f}'
+                  for endpoint, seconds in sorted(sql_seconds.items())]
+        lines += ['# HELP handicap_function_calls_total Calls of the timed handicap calculation functions.',
+                  '# TYPE handicap_function_calls_total counter']
+        lines += [f'handicap_function_calls_total{{function="{name}"}} {count}' for name, count in sorted(calls.items())]
+        lines += ['# HELP handicap_function_seconds_total Time spent in the timed functions, including timed calls they make.',
+                  '# TYPE handicap_function_seconds_total counter']
+        lines += [f'handicap_function_seconds_total{{function="{name}"}} {seconds:.6f}'
+                  for name, seconds in sorted(call_seconds.items())]
+        lines += ['# HELP handicap_boot_seconds Time the app spent in each start up phase.',
+                  '# TYPE handicap_boot_seconds gauge']
+        lines += [f'handicap_boot_seconds{{phase="{phase}"}} {seconds:.6f}' for phase, seconds in self.boot_seconds.items()]
+        return '\n'.join(lines) + '\n'
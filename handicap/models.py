@@ -1,16 +1,59 @@
+import hashlib
+import secrets
 from typing import List, Optional
 from datetime import date
 from itsdangerous import URLSafeTimedSerializer as Serialiser # allows confirmed data coming back as sent in password updating.
 from flask_login import UserMixin
-from sqlalchemy import ForeignKey, String
-from sqlalchemy.orm import Mapped, mapped_column, relationship
-from flask_mail import Message
-from flask import url_for, current_app as app
-from handicap import db, login_manager, mail
+from sqlalchemy import ForeignKey, Index, String, select
+from sqlalchemy.orm import Mapped, mapped_column, relationship, make_transient_to_detached
+from flask import g, url_for, request, current_app as app
+from handicap import db, login_manager, mailer, user_cache
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """
+    Load the logged in user, once per request (Flask-Login keeps it for the rest of the request).
+
+    Page views are served from the user cache, rebuilding the user in the session from its cached columns.
+    Only the version is read, a primary key seek, so a change made in another worker process (which bumps
+    it) is seen at once: the ETags, page fragments and snapshots keyed by the version are never stale.
+    Requests that may change data always load the row as it is now, so the optimistic concurrency
+    check on the player's version is never made against a cached copy.
+    """
+    user_id = int(user_id)
+    if request.method not in ('GET', 'HEAD'):
+        return db.session.get(User, user_id)
+    columns = user_cache.get(user_id)
+    if columns is not None and columns['version'] != db.session.scalar(select(User.version).where(User.id == user_id)):
+        user_cache.invalidate(user_id)      # Changed (or deleted) since it was cached.
+        columns = None
+    if columns is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.put(user_id, {key: getattr(user, key) for key in User.__table__.columns.keys()})
+        return user
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)   # Joins the session as loaded, without a query.
+
+@login_manager.request_loader
+def load_api_client(request):
+    """
+    Load the user of an API token given as 'Authorization: Bearer <token>', for machine clients of the JSON API.
+    Tokens are only accepted by the API, so they can't be used to browse the site. Whether the token may read
+    every player's data, not only its owner's, is kept for the request in g.club_client.
+    """
+    if request.blueprint != 'api':
+        return None
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    row = db.session.execute(select(User, ApiToken.club).join(ApiToken)
+                             .where(ApiToken.token_hash == ApiToken.hash(token.strip()))).first()
+    if row is None:
+        return None
+    g.club_client = row.club
+    return row.User
 
 class User(db.Model, UserMixin):
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -21,10 +64,19 @@ class User(db.Model, UserMixin):
     handicap_index: Mapped[Optional[float]]
     low_handicap_index: Mapped[Optional[float]]
     low_handicap_index_date: Mapped[Optional[date]]
+    version: Mapped[int] = mapped_column(default=0, server_default='0')     # Bumped by every change to the player's scoring record.
 
     scores: Mapped[List['Score']] = relationship(back_populates='shot_by', cascade='all, delete-orphan')
     indexes: Mapped[List['IndexHistory']] = relationship(back_populates='player', cascade='all, delete-orphan')
     nine_hole_scores: Mapped[List['NineHoleScore']] = relationship(back_populates='shot_by', cascade='all, delete-orphan')
+    api_tokens: Mapped[List['ApiToken']] = relationship(back_populates='owner', cascade='all, delete-orphan')
+
+    # Optimistic concurrency: an update only succeeds if the version is still the one read.
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
+
+    def bump_version(self):
+        """Mark the player's data as changed. The commit fails with StaleDataError if another change was committed first."""
+        self.version = (self.version or 0) + 1
 
     def get_reset_token(self):
         s = Serialiser(app.config['SECRET_KEY'], salt='password-reset')
@@ -32,6 +84,7 @@ class User(db.Model, UserMixin):
         return token
     
     def send_reset_email(self):
+        from flask_mail import Message     # Imported on first use, to keep it out of the app's start up.
         token = self.get_reset_token()
         msg = Message('Message from Handicap Index', sender='phil@cluesome.com', recipients=[self.email])
         msg.body = f'''To reset your password, visit the following link:
@@ -40,7 +93,7 @@ class User(db.Model, UserMixin):
 The link will expire after 30 minutes.
 If you did not make this request, please ignore this email.
 '''
-        mail.send(msg)
+        return mailer.send(msg)     # Queued, to be sent in the background.
   
     @staticmethod
     def verify_reset_token(token, expires_sec=60*30):   # 30 minutes.
@@ -69,9 +122,13 @@ class Score(db.Model):
     course: Mapped[Optional[str]]
     holes: Mapped[int] = mapped_column(default=18)
     score_differential: Mapped[float]
+    pcc: Mapped[int] = mapped_column(default=0, server_default='0')     # The playing conditions adjustment in the differential.
     user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
     shot_by: Mapped['User'] = relationship(back_populates='scores')
 
+    __table_args__ = (Index('ix_score_user_id_played', 'user_id', 'played'),   # A player's most recent rounds.
+                      Index('ix_score_played_course', 'played', 'course'))  # The rounds of an event, for its leaderboard.
+
     def __repr__(self):
         return f"Score({self.id}, '{self.played}', {self.course_rating}, {self.course_slope}, {self.gross_adjusted_score}, '{self.course}', {self.score_differential}, {self.user_id})"
 
@@ -88,13 +145,60 @@ class NineHoleScore(db.Model):
     def __repr__(self):
         return f"NineHoleScore({self.id}, '{self.played}', {self.course_rating}, {self.course_slope}, {self.gross_adjusted_score}, '{self.course}', {self.user_id})"
     
+class ApiToken(db.Model):
+    """A token a machine client of the JSON API authenticates with, as its owner. Only a hash of the token is kept."""
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(40))   # What the token is for, e.g. the club's tee sheet.
+    token_hash: Mapped[str] = mapped_column(String(64), unique=True)
+    created: Mapped[date]
+    club: Mapped[bool] = mapped_column(default=False, server_default='0')   # May read every player's data, not only the owner's.
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+
+    owner: Mapped['User'] = relationship(back_populates='api_tokens')
+
+    @staticmethod
+    def hash(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @classmethod
+    def issue(cls, user: User, name: str, club: bool=False) -> str:
+        """
+        Add a new token for a user to the session, and return it; it can't be recovered later. The caller commits.
+        A club token (e.g. for the club's tee sheet) reads every player's data; any other only its owner's.
+        """
+        token = secrets.token_urlsafe(32)
+        db.session.add(cls(name=name, token_hash=cls.hash(token), created=date.today(), club=club, user_id=user.id))
+        return token
+
+    def __repr__(self):
+        return f"ApiToken({self.id}, '{self.name}', '{self.created}', {self.club}, {self.user_id})"
+
+class PlayingConditions(db.Model):
+    """The running totals of the acceptable scores on a course on a day, and the playing conditions adjustment applied to them."""
+    course: Mapped[str] = mapped_column(primary_key=True)
+    played: Mapped[date] = mapped_column(primary_key=True)
+    scores: Mapped[int] = mapped_column(default=0)      # Acceptable scores: by players with an index up to PCC_MAX_INDEX.
+    total_margin: Mapped[float] = mapped_column(default=0.0)    # The sum of their differentials less their indexes.
+    pcc: Mapped[int] = mapped_column(default=0)     # The adjustment applied to the day's differentials.
+    pending: Mapped[bool] = mapped_column(default=True)     # The scores have changed since the adjustment was applied.
+
+    __table_args__ = (Index('ix_playing_conditions_pending', 'pending', 'played'),)  # The days to adjust.
+
+    def __repr__(self):
+        return f"PlayingConditions('{self.course}', '{self.played}', {self.scores}, {self.total_margin}, {self.pcc})"
+
 class IndexHistory(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     handicap_index: Mapped[float]
     handicap_index_date: Mapped[date]
+    # The low handicap index after the round, a checkpoint from which later history can be replayed.
+    low_handicap_index: Mapped[Optional[float]]
+    low_handicap_index_date: Mapped[Optional[date]]
     user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
 
     player: Mapped['User'] = relationship(back_populates='indexes')
 
+    __table_args__ = (Index('ix_index_history_user_id_date', 'user_id', 'handicap_index_date'),)  # A player's index on a date.
+
     def __repr__(self):
         return f"IndexHistory({self.id}, {self.handicap_index}, '{self.handicap_index_date}', {self.user_id})"
\ No newline at end of file
@@ -0,0 +1,162 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from sqlalchemy import bindparam, delete, insert, select, update
+from handicap import db
+from handicap.models import User, Score, IndexHistory
+from handicap.handicap import WINDOW_SIZE, counting_size, adjusted_index, reevaluate_low_index
+from handicap.history import IndexTimeline
+
+# The number of counting differentials and the adjustment, indexed by rounds played (capped at the window size).
+COUNTING = np.array([counting_size(rounds_played) for rounds_played in range(WINDOW_SIZE + 1)])
+
+def windowed_averages(differentials: np.ndarray) -> np.ndarray:
+    """
+    Average the lowest score differentials of the window ending at each round, all rounds at once.
+
+    Parameters:
+    differentials (ndarray): a player's score differentials in played date order.
+
+    Returns:
+    An array of the average after each round (NaN for the first two rounds).
+    The lowest differentials are summed in ascending order, as ScoringRecord.handicapIndex() does,
+    so the averages are identical to its own.
+    """
+    rounds = len(differentials)
+    padded = np.concatenate([np.full(WINDOW_SIZE - 1, np.inf), differentials])
+    # Each row is the window ending at a round, lowest differential first.
+    windows = np.sort(sliding_window_view(padded, WINDOW_SIZE), axis=1)
+    totals = np.cumsum(windows, axis=1)
+    counting = COUNTING[np.minimum(np.arange(1, rounds + 1), WINDOW_SIZE), 0]
+    divisors = np.maximum(counting, 1)
+    return np.where(counting > 0, totals[np.arange(rounds), divisors - 1] / divisors, np.nan)
+
+def player_history(played: np.ndarray, differentials: np.ndarray,
+                   low_handicap_index: float, low_handicap_index_date: date) -> tuple:
+    """
+    Recompute a player's index history from their rounds, as replaying them through ScoringRecord would.
+
+    Parameters:
+    played (ndarray): the date ordinals of the rounds, in played date (then id) order.
+    differentials (ndarray): the rounds' score differentials, in the same order.
+    low_handicap_index (float), low_handicap_index_date (date): the player's current low handicap index,
+    kept if there are fewer than 20 rounds.
+
+    Returns:
+    A 4-tuple of:
+    a list of (handicap index, date, low handicap index, low handicap index date) for the index history,
+    the handicap index, the low handicap index and its date.
+    """
+    averages = windowed_averages(differentials).tolist()
+    handicap_index = None
+    timeline = IndexTimeline()  # The rounds come in date order, so the history can be appended as it is made.
+    history = []
+    for count, (ordinal, score_differential, average) in enumerate(zip(played.tolist(), differentials.tolist(), averages)):
+        rounds_played = count + 1
+        round_date = date.fromordinal(ordinal)
+        if rounds_played < 3:
+            handicap_index = None
+            continue
+        _, adjustment = COUNTING[min(rounds_played, WINDOW_SIZE)]
+        if rounds_played == 20:
+            low_handicap_index, low_handicap_index_date = round(average, 1), round_date
+        handicap_index = adjusted_index(average, rounds_played, int(adjustment), low_handicap_index)
+        history_index = handicap_index
+        if handicap_index is not None:
+            timeline.append(round_date, handicap_index)
+        if rounds_played >= 20:
+            handicap_index, low_handicap_index, low_handicap_index_date = \
+                reevaluate_low_index(round_date, score_differential, handicap_index,
+                                     low_handicap_index, low_handicap_index_date, timeline)
+        if history_index is not None:
+            established = rounds_played >= 20
+            history.append((history_index, round_date,
+                            low_handicap_index if established else None,
+                            low_handicap_index_date if established else None))
+    return history, handicap_index, low_handicap_index, low_handicap_index_date
+
+def _recompute_batch(batch: list[tuple]) -> list[tuple]:
+    """Recompute a batch of (user id, played, differentials, low HI, low HI date) players in a worker process."""
+    return [(user_id, *player_history(played, differentials, low, low_date))
+            for user_id, played, differentials, low, low_date in batch]
+
+def _recompute_batches(batches: list[list[tuple]], workers: int):
+    """Yield the recomputed batches, from a process pool if there is more than one batch to share out."""
+    if workers == 1 or len(batches) <= 1:
+        yield from map(_recompute_batch, batches)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(_recompute_batch, batches)
+
+def load_rounds() -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    """
+    Load every player's rounds into columnar arrays with one query.
+
+    Returns:
+    A dict from user id to a tuple of (date ordinals, score differentials), in played date then id order.
+    """
+    rows = db.session.execute(select(Score.user_id, Score.played, Score.score_differential)
+                              .order_by(Score.user_id, Score.played, Score.id)
+                              .execution_options(yield_per=50_000))
+    user_ids, played, differentials = [], [], []
+    for partition in rows.partitions():
+        for user_id, round_date, score_differential in partition:
+            user_ids.append(user_id)
+            played.append(round_date.toordinal())
+            differentials.append(score_differential)
+    user_ids = np.array(user_ids, dtype=np.int64)
+    played = np.array(played, dtype=np.int64)
+    differentials = np.array(differentials, dtype=np.float64)
+    # Split the columns at the start of each player's rounds.
+    players, starts = np.unique(user_ids, return_index=True)
+    return {int(user_id): (played_split, differentials_split)
+            for user_id, played_split, differentials_split
+            in zip(players, np.split(played, starts[1:]), np.split(differentials, starts[1:]))}
+
+def recompute_all(workers: int=None, batch_size: int=200, chunk_size: int=10_000) -> int:
+    """
+    Recompute every player's handicap index, low handicap index and index history from their rounds.
+
+    The rounds are loaded in bulk, players are spread across a process pool in batches,
+    and the results are written back with bulk inserts and updates in one transaction.
+    Each player's version is bumped, so the web workers' cached snapshots are recalculated.
+
+    Parameters:
+    workers (int): the number of worker processes (default: one per CPU; 1 computes in this process).
+    batch_size (int): the number of players sent to a worker at a time.
+    chunk_size (int): the number of index history rows per bulk insert.
+
+    Returns:
+    The number of players recomputed.
+    """
+    rounds = load_rounds()
+    lows = {user_id: (low, low_date) for user_id, low, low_date in
+            db.session.execute(select(User.id, User.low_handicap_index, User.low_handicap_index_date))}
+    players = [(user_id, played, differentials, *lows[user_id]) for user_id, (played, differentials) in rounds.items()]
+    batches = [players[start:start + batch_size] for start in range(0, len(players), batch_size)]
+
+    db.session.execute(delete(IndexHistory))   # The history is derived from the rounds alone.
+    history_rows, user_rows = [], []
+    for batch in _recompute_batches(batches, workers or os.cpu_count()):
+        for user_id, history, handicap_index, low_handicap_index, low_handicap_index_date in batch:
+            history_rows.extend(dict(user_id=user_id, handicap_index=HI, handicap_index_date=HI_date,
+                                     low_handicap_index=low, low_handicap_index_date=low_date)
+                                for HI, HI_date, low, low_date in history)
+            user_rows.append(dict(user_id=user_id, handicap_index=handicap_index,
+                                  low_handicap_index=low_handicap_index, low_handicap_index_date=low_handicap_index_date))
+            if len(history_rows) >= chunk_size:
+                db.session.execute(insert(IndexHistory.__table__), history_rows)
+                history_rows = []
+    if history_rows:
+        db.session.execute(insert(IndexHistory.__table__), history_rows)
+    if user_rows:
+        users = User.__table__
+        db.session.execute(update(users).where(users.c.id == bindparam('user_id'))
+                           .values(handicap_index=bindparam('handicap_index'),
+                                   low_handicap_index=bindparam('low_handicap_index'),
+                                   low_handicap_index_date=bindparam('low_handicap_index_date'),
+                                   version=users.c.version + 1), user_rows)
+    db.session.commit()
+    return len(players)
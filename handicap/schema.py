@@ -0,0 +1,68 @@
+import hashlib
+from sqlalchemy import Column, String, Table, delete, insert, inspect, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+from handicap import db
+
+# The fingerprint of the models the schema was last brought up to date with.
+schema_version = Table('schema_version', db.metadata, Column('fingerprint', String(64), primary_key=True))
+
+def schema_fingerprint(dialect) -> str:
+    """Return a hash of the DDL of the models' tables and indexes, which changes whenever they do."""
+    digest = hashlib.sha256()
+    for table in db.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()
+
+def recorded_fingerprint():
+    """Return the fingerprint recorded in the database, or None if there isn't one (or no schema_version table)."""
+    try:
+        with db.engine.connect() as connection:
+            return connection.scalar(select(schema_version.c.fingerprint))
+    except DBAPIError:
+        return None
+
+def ensure_schema(check: str='version') -> bool:
+    """
+    Create or upgrade the database schema at start up, unless it is already up to date with the models.
+
+    Parameters:
+    check (str): 'version' compares a fingerprint of the models with the one recorded when the schema
+    was last upgraded, so an up to date database costs one query rather than reflecting every table.
+    'always' creates and upgrades the schema regardless.
+
+    Returns:
+    True if the schema was created or upgraded, False if it was current.
+    """
+    fingerprint = schema_fingerprint(db.engine.dialect)
+    if check == 'version' and recorded_fingerprint() == fingerprint:
+        return False
+    db.create_all()
+    upgrade_schema()    # Add any columns and indexes missing from existing tables.
+    with db.engine.begin() as connection:
+        connection.execute(delete(schema_version))
+        connection.execute(insert(schema_version).values(fingerprint=fingerprint))
+    return True
+
+def upgrade_schema() -> None:
+    """
+    Bring an existing database up to date with the models.
+
+    db.create_all() creates the tables that are missing, with their indexes, but leaves existing
+    tables alone. Columns and indexes added to the models since a table was created are added here.
+    New columns must therefore be nullable or have a server default.
+    """
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)     # On the same connection, which may hold the write lock.
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_ddl}'))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
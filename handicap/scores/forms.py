@@ -1,5 +1,6 @@
 from datetime import date
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, SubmitField, FloatField, IntegerField, DateField
 from wtforms.validators import DataRequired, NumberRange, Optional, ValidationError, AnyOf
 
@@ -19,4 +20,9 @@ class ScoreForm(FlaskForm):
     def validate_played(self, played):
         today = date.today()
         if played.data > today:
-            raise ValidationError('The date must be in the past.')
\ No newline at end of file
+            raise ValidationError('The date must be in the past.')
+
+class ImportForm(FlaskForm):
+    rounds_file = FileField('Rounds File (CSV or JSON Lines)',
+                            validators=[FileRequired(), FileAllowed(['csv', 'json', 'jsonl'])])
+    submit = SubmitField('Import')
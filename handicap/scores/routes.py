@@ -1,88 +1,147 @@
+import io
+import time
 from copy import deepcopy
+from functools import partial
 from flask import render_template, url_for, redirect, flash, request, abort, Blueprint
 from flask_login import current_user, login_required
-from handicap import db
-from handicap.scores.forms import ScoreForm
-from handicap.models import Score, IndexHistory
-from handicap.handicap import ScoringRecord
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from handicap import db, snapshots, user_cache, fragments
+from handicap.scores.forms import ScoreForm, ImportForm
+from handicap.scores.utils import import_scores, encode_cursor, decode_cursor
+from handicap.models import Score
+from handicap.handicap import ScoringRecord, score_view
+from handicap.conditions import refresh_conditions
+from handicap.caching import conditional, conditional_response
+from handicap.sqlite import is_locked
 
 scores = Blueprint('scores', __name__)
 
-@scores.route("/allscores", methods=['GET', 'POST'])
-def all_scores():
-    page = request.args.get('page', 1, type=int)    # Default to page 1.
-    per_page = request.args.get('per_page', 5, type=int)   # Default to 6 scores per page.#
-    if current_user.is_authenticated:
-        player = current_user.name
-        player_record = ScoringRecord(current_user.id)
-        current_index = player_record.handicapIndex()
-        hi = round(current_index, 1) if current_index else None
+POST_ATTEMPTS = 3   # Tries at posting a round that races with another change to the player's record.
+LOCKED_BACKOFF = 0.05    # Seconds before trying again when SQLite's write lock was taken, doubling each time.
+PAGE_NUMBERS_UP_TO = 10     # Histories of up to this many pages are numbered; longer ones are paged by cursor.
+
+def score_page(page: int | None, per_page: int, cursor) -> dict:
+    """
+    Return a page of the logged in player's rounds, most recent first, and the links to the others:
+    numbered pages while the offsets they need stay small, and cursors from the rounds next to the page after that.
+    """
+    player_record = ScoringRecord(current_user)
+    newer_cursor = older_cursor = None
+    # The record counts the rounds, so page numbers are used while the offsets they need stay small.
+    pages = -(-player_record.window.rounds_played // per_page)
+    if page is not None or (cursor is None and pages <= PAGE_NUMBERS_UP_TO):
+        page = page or 1    # Default to page 1.
         scores, page_nos = player_record.scorePage(per_page, page)
         show_page_buttons = len(page_nos) > 1
-        del player_record
-        # Adjust played dates format for display.  
-        for score in scores:
-            score.played = score.played.strftime('%d-%m-%Y')
     else:
-        player = ""
-        hi = None
-        show_page_buttons = False
-        scores = []
+        # Seek to the page from the round next to it, so deep pages cost the same as the first.
+        direction, key = cursor if cursor else (None, None)
+        scores, newer, older = player_record.scoreSeek(per_page, after=key if direction == 'after' else None,
+                                                       before=key if direction == 'before' else None)
+        if scores:
+            newer_cursor = encode_cursor('before', scores[0]) if newer else None
+            older_cursor = encode_cursor('after', scores[-1]) if older else None
         page_nos = []
-    #print(f"Scores length: {len(scores)}")
-    return render_template('allscores.html', player=player, hi=hi,
-                           login=current_user.is_authenticated,
-                           len_scores=len(scores), scores=scores,
-                           show_page_buttons=show_page_buttons,
-                           page_nos=page_nos, page=page)
+        show_page_buttons = False
+    # Adjust played dates format for display.
+    scores = [score._replace(played=score.played.strftime('%d-%m-%Y')) for score in scores]
+    return dict(scores=scores, page=page, page_nos=page_nos, show_page_buttons=show_page_buttons,
+                newer_cursor=newer_cursor, older_cursor=older_cursor)
+
+@scores.route("/allscores", methods=['GET', 'POST'])
+@conditional
+def all_scores():
+    page = request.args.get('page', type=int)
+    per_page = request.args.get('per_page', 5, type=int)   # Default to 6 scores per page.#
+    if per_page < 1:
+        abort(404)      # As Flask-SQLAlchemy's paginate does.
+    cursor = decode_cursor(request.args.get('cursor'))
+    # The page is only read when its cached fragment is out of date.
+    return render_template('allscores.html', login=current_user.is_authenticated,
+                           page=page, per_page=per_page, cursor=cursor,
+                           score_page=partial(score_page, page, per_page, cursor))
 
 @scores.route('/score/new', methods=['GET', 'POST'])
 @login_required
 def new_score():
     form = ScoreForm(holes=18)                              # Default to 18 holes for convenience.
     if form.validate_on_submit():
-        score = Score(played=form.played.data,
-                      course_rating=form.rating.data,
-                      course_slope=form.slope.data,
-                      gross_adjusted_score=form.strokes.data,
-                      course=form.course.data,
-                      holes=form.holes.data,
-                      # Compute the derived scoring differential.
-                      score_differential=(form.strokes.data - form.rating.data) * 113 / form.slope.data,
-                      user_id=current_user.id,
-                      shot_by=current_user)
-        scoring_record = ScoringRecord(current_user.id)
-        #print(f"Old handicap index: {current_user.handicap_index}")
-        current_user.handicap_index = scoring_record.addRound(score) # Add the score to the scoring record. (PJIS does this update the user's db record on commit? If not it should update the User record in handicap.py)
-        #print(f"New handicap index: {current_user.handicap_index}")
-        del scoring_record
-        db.session.commit()
+        for attempt in range(POST_ATTEMPTS):
+            score = Score(played=form.played.data,
+                          course_rating=form.rating.data,
+                          course_slope=form.slope.data,
+                          gross_adjusted_score=form.strokes.data,
+                          course=form.course.data,
+                          holes=form.holes.data,
+                          # Compute the derived scoring differential.
+                          score_differential=(form.strokes.data - form.rating.data) * 113 / form.slope.data,
+                          user_id=current_user.id)
+            try:
+                # Add the score to the scoring record, updating the user's handicap in the same commit.
+                ScoringRecord(current_user).addRound(score)
+                break
+            except StaleDataError:
+                # Another change to the player's record was committed first; start again from it.
+                db.session.rollback()
+            except OperationalError as error:
+                if not is_locked(error):
+                    raise
+                # Another request held SQLite's write lock (outside the production config's immediate writes).
+                db.session.rollback()
+                time.sleep(LOCKED_BACKOFF * 2 ** attempt)
+        else:
+            flash('Your score could not be added, please try again.', 'danger')
+            return redirect(url_for('scores.new_score'))
         flash('Your score has been added!', 'success')
         return redirect(url_for('main.home'))
-    current_user.handicap_index = ScoringRecord(current_user.id).handicapIndex()
     return render_template('create_score.html', title='Add Round',
-                           player=current_user.name, hi=current_user.handicap_index, 
                            form=form, legend='New Round')
 
+@scores.route('/score/import', methods=['GET', 'POST'])
+@login_required
+def import_rounds():
+    form = ImportForm()
+    if form.validate_on_submit():
+        upload = form.rounds_file.data
+        file_format = 'csv' if upload.filename.lower().endswith('.csv') else 'jsonl'
+        # Read the upload as a stream, so large files are never held in memory.
+        # One transaction: other players' posts wait for the database until it commits.
+        start = time.perf_counter()
+        try:
+            imported, errors = import_scores(current_user.id, io.TextIOWrapper(upload.stream, encoding='utf-8-sig'), file_format)
+        except StaleDataError:
+            # Another change to the player's record was committed first; nothing was imported.
+            db.session.rollback()
+            flash('Your record changed while the file was imported, so none of it was; please try again.', 'danger')
+            return redirect(url_for('scores.import_rounds'))
+        flash(f'{imported} rounds imported together in {time.perf_counter() - start:.1f}s, '
+              'while other players\' scores waited to be posted.', 'success' if imported else 'warning')
+        for error in errors:
+            flash(error, 'danger')
+        return redirect(url_for('scores.all_scores'))
+    return render_template('import_scores.html', title='Import Rounds',
+                           form=form, legend='Import Rounds')
+
 @scores.route('/score/<int:score_id>')
 def score(score_id):
-    score = Score.query.get_or_404(score_id)
-    if score.shot_by != current_user:
+    score = score_view(score_id)
+    if score is None:
+        abort(404)
+    if not current_user.is_authenticated or score.user_id != current_user.id:
         abort(403)
-    current_user.handicap_index = ScoringRecord(current_user.id).handicapIndex()
-    score_date = score.played.strftime('%d-%m-%Y')
-    return render_template('score.html', title='Round Score',
-                           player=current_user.name if current_user.is_active else "",
-                           hi=current_user.handicap_index if current_user.is_active else "",
-                           score=score, played=score_date)
+    # Only once the round is known to be the player's, so a cached page is never confirmed for anyone else's.
+    return conditional_response(lambda: render_template('score.html', title='Round Score', score=score,
+                                                        played=score.played.strftime('%d-%m-%Y')))
 
 @scores.route('/score/<int:score_id>/update', methods=['GET', 'POST'])
 @login_required
 def update_score(score_id):
     score = Score.query.get_or_404(score_id)
-    if score.shot_by != current_user:
+    if score.user_id != current_user.id:
         abort(403)
     remember_date = score.played
+    remember_day = (score.course, score.played)
     form = ScoreForm()
     if form.validate_on_submit():
         # Update the score record. The scoring differential is recalculated.
@@ -93,15 +152,23 @@ def update_score(score_id):
         score.course = form.course.data
         score.holes = form.holes.data
         score.score_differential = (form.strokes.data - form.rating.data) * 113 / form.slope.data
-        db.session.commit()
-        # Update the index history record.
-        scoring_record = ScoringRecord(current_user.id)
-        handicap_index = scoring_record.handicapIndex()
-        del scoring_record 
-        index_history = IndexHistory.query.filter_by(user_id=current_user.id).all()
-        update_ih = next((ih for ih in index_history if ih.handicap_index_date == remember_date), None)
-        update_ih.handicap_index = handicap_index
-        db.session.commit()
+        score.pcc = 0   # Until the day's playing conditions adjustment is applied again.
+        db.session.flush()
+        refresh_conditions([remember_day, (score.course, score.played)])
+        # Replay the index history from whichever of the old and new dates is earlier.
+        scoring_record = ScoringRecord(current_user)
+        scoring_record.replayFrom(min(remember_date, score.played))
+        del scoring_record
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # Another change to the player's record was committed first.
+            db.session.rollback()
+            flash('Your score could not be updated, please try again.', 'danger')
+            return redirect(url_for('scores.score', score_id=score_id))
+        snapshots.invalidate(current_user.id)
+        fragments.invalidate(current_user.id)
+        user_cache.invalidate(current_user.id)
         flash('Your score has been updated!', 'success')
         return redirect(url_for('scores.score', score_id=score.id))
     elif request.method == 'GET':
@@ -112,18 +179,30 @@ def update_score(score_id):
         form.course.data = score.course
         form.holes.data = score.holes
 
-    current_user.handicap_index = ScoringRecord(current_user.id).handicapIndex()
     return render_template('create_score.html', title='Update Score',
-                           player=current_user.name, hi=current_user.handicap_index,
                            form=form, legend='Update Score')
 
 @scores.route('/score/<int:score_id>/delete', methods=['POST'])
 @login_required
 def delete_score(score_id):
     score = Score.query.get_or_404(score_id)
-    if score.shot_by != current_user:
+    if score.user_id != current_user.id:
         abort(403)
+    remember_date = score.played
     db.session.delete(score)
-    db.session.commit()
+    db.session.flush()
+    refresh_conditions([(score.course, score.played)])
+    # Replay the index history without the deleted round.
+    ScoringRecord(current_user).replayFrom(remember_date)
+    try:
+        db.session.commit()
+    except StaleDataError:
+        # Another change to the player's record was committed first.
+        db.session.rollback()
+        flash('Your score could not be deleted, please try again.', 'danger')
+        return redirect(url_for('scores.score', score_id=score_id))
+    snapshots.invalidate(current_user.id)
+    fragments.invalidate(current_user.id)
+    user_cache.invalidate(current_user.id)
     flash('Your score has been deleted!', 'success')
     return redirect(url_for('main.home'))
@@ -0,0 +1,180 @@
+import csv
+import json
+from datetime import date
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from werkzeug.datastructures import MultiDict
+from sqlalchemy import Column, Date, Float, Integer, MetaData, String, Table, delete, func, insert, select, tuple_
+from handicap import db, snapshots, user_cache, fragments
+from handicap.models import Score
+from handicap.scores.forms import ScoreForm
+from handicap.handicap import ScoringRecord
+from handicap.conditions import refresh_conditions
+
+IMPORT_FIELDS = ('course', 'played', 'strokes', 'rating', 'slope', 'holes')     # The ScoreForm fields, as column headings.
+# The columns of a new round; its playing conditions adjustment is left to the column default.
+SCORE_COLUMNS = [column.key for column in Score.__table__.columns if column.key not in ('id', 'pcc')]
+# The 9 hole rounds of an import, staged in the connection's temporary schema to be read back in played date order.
+# Kept out of the models' metadata, so the schema upgrade leaves it alone.
+staged_nine_hole_rounds = Table('staged_nine_hole_round', MetaData(),
+                                Column('id', Integer, primary_key=True),    # The file order, for rounds on the same date.
+                                Column('played', Date, nullable=False, index=True),
+                                Column('course_rating', Float, nullable=False),
+                                Column('course_slope', Integer, nullable=False),
+                                Column('gross_adjusted_score', Integer, nullable=False),
+                                Column('course', String),
+                                prefixes=['TEMPORARY'])
+
+def cursor_serialiser() -> URLSafeSerializer:
+    """Return the serialiser that signs page cursors, so they can't be edited to seek into someone else's rounds order."""
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='scores-cursor')
+
+def encode_cursor(direction: str, score) -> str:
+    """
+    Return an opaque cursor token for the page next to a score.
+
+    Parameters:
+    direction (str): 'after' for the page following the score, 'before' for the page preceding it.
+    score (Score): the last (for 'after') or first (for 'before') round shown on the current page.
+    """
+    return cursor_serialiser().dumps([direction, score.played.toordinal(), score.id])
+
+def decode_cursor(token: str | None) -> tuple[str, tuple[date, int]] | None:
+    """
+    Return the direction and (played, id) key of a cursor token, or None if there is no valid token.
+    """
+    if not token:
+        return None
+    try:
+        direction, played, score_id = cursor_serialiser().loads(token)
+        key = (date.fromordinal(played), int(score_id))
+    except (BadSignature, ValueError, TypeError, OverflowError):
+        return None
+    if direction not in ('after', 'before'):
+        return None
+    return direction, key
+
+def read_rounds(stream, file_format: str):
+    """
+    Yield the rows of a rounds file one at a time, as dicts of the ScoreForm fields.
+
+    Parameters:
+    stream: a text stream of the file.
+    file_format (str): 'csv' (with a heading row) or 'jsonl' (one JSON object per line).
+    """
+    if file_format == 'csv':
+        rows = csv.DictReader(stream)
+    else:
+        rows = (json.loads(line) for line in stream if line.strip())
+    for row in rows:
+        yield {field: str(row[field]) for field in IMPORT_FIELDS if row.get(field) not in (None, '')}
+
+def import_scores(player_id: int, stream, file_format: str='csv', chunk_size: int=1000, max_errors: int=50) -> tuple[int, list[str]]:
+    """
+    Import a file of rounds into a player's scoring record, as one unit of work.
+
+    Each row is validated by ScoreForm. 18 hole rounds are inserted in bulk a chunk at a time, and 9 hole rounds
+    staged a chunk at a time in a temporary table, so memory use does not grow with the length of the file.
+    The 9 hole rounds are then read back a page at a time in the order they were played, whatever the order
+    of the file, and combined or converted as addRound() does, each counting the rounds played before it.
+    The index history is replayed from the earliest round imported, and everything committed at once:
+    if the player's record changes meanwhile, the commit fails with StaleDataError and nothing is written;
+    the caller rolls back and may try again.
+
+    One transaction, rather than one per chunk, is the trade-off for never leaving a record half imported
+    or its history unreplayed: it holds SQLite's write lock from the first insert (from the start, with
+    SQLITE_IMMEDIATE_WRITES) until the commit, a few seconds per 10,000 rows, and the uncommitted rounds
+    are kept in the write-ahead log meanwhile. Other players' posts wait for it, up to busy_timeout.
+
+    Parameters:
+    player_id (int): the id of the player.
+    stream: a text stream of the file.
+    file_format (str): 'csv' or 'jsonl'.
+    chunk_size (int): the number of rounds inserted per statement, and 9 hole rounds read back per query.
+    max_errors (int): the most invalid rows reported.
+
+    Returns:
+    A tuple of the number of rows imported and messages for the rows that were not.
+    """
+    scoring_record = ScoringRecord(player_id)
+    imported, errors, chunk, nine_hole_chunk, earliest = 0, [], [], [], None
+    form = ScoreForm(formdata=None, meta={'csrf': False})     # Reused for every row.
+    connection = db.session.connection()
+    staged_nine_hole_rounds.create(connection, checkfirst=True)
+    connection.execute(delete(staged_nine_hole_rounds))     # Any left by a failed import on this connection.
+
+    def write() -> None:
+        nonlocal chunk
+        if chunk:
+            connection.execute(insert(Score.__table__), chunk)
+            refresh_conditions((row['course'], row['played']) for row in chunk)
+            chunk = []
+
+    def add(score: Score) -> None:
+        nonlocal earliest
+        earliest = min(earliest, score.played) if earliest else score.played
+        chunk.append({column: getattr(score, column) for column in SCORE_COLUMNS})
+        if len(chunk) >= chunk_size:
+            write()
+
+    for row_number, row in enumerate(read_rounds(stream, file_format), start=1):
+        form.process(formdata=MultiDict(row))
+        if not form.validate():
+            if len(errors) < max_errors:
+                errors.append(f'Row {row_number}: ' + ' '.join(f'{form[field].label.text}: {", ".join(messages)}'
+                                                                for field, messages in form.errors.items()))
+            continue
+        imported += 1
+        if form.holes.data == 9:
+            # Combined or converted once the rounds played before it are known.
+            nine_hole_chunk.append(dict(played=form.played.data, course_rating=form.rating.data, course_slope=form.slope.data,
+                                        gross_adjusted_score=form.strokes.data, course=form.course.data))
+            if len(nine_hole_chunk) >= chunk_size:
+                connection.execute(insert(staged_nine_hole_rounds), nine_hole_chunk)
+                nine_hole_chunk = []
+            continue
+        add(Score(played=form.played.data,
+                  course_rating=form.rating.data,
+                  course_slope=form.slope.data,
+                  gross_adjusted_score=form.strokes.data,
+                  course=form.course.data,
+                  holes=form.holes.data or 18,
+                  # Compute the derived scoring differential.
+                  score_differential=(form.strokes.data - form.rating.data) * 113 / form.slope.data,
+                  user_id=player_id))
+    if nine_hole_chunk:
+        connection.execute(insert(staged_nine_hole_rounds), nine_hole_chunk)
+    write()
+
+    # Whether a 9 hole round waits for another or is converted depends on the rounds played before it.
+    staged = staged_nine_hole_rounds.c
+    nine_hole_rounds = select(staged_nine_hole_rounds).order_by(staged.played, staged.id).limit(chunk_size)
+    page = connection.execute(nine_hole_rounds).all()
+    rounds_played = 0
+    while page:
+        for staged_round in page:
+            if rounds_played < 3:   # Only counted while it matters; the count never falls as the dates rise.
+                write()
+                rounds_played = db.session.scalar(select(func.count()).select_from(Score)
+                                                  .where(Score.user_id == player_id, Score.played <= staged_round.played))
+            score = scoring_record.eighteenHoleRound(Score(played=staged_round.played, course_rating=staged_round.course_rating,
+                                                           course_slope=staged_round.course_slope,
+                                                           gross_adjusted_score=staged_round.gross_adjusted_score,
+                                                           course=staged_round.course, holes=9, user_id=player_id),
+                                                     rounds_played)
+            if score is not None:
+                add(score)
+                rounds_played += 1
+        last = page[-1]
+        page = connection.execute(nine_hole_rounds.where(tuple_(staged.played, staged.id) > (last.played, last.id))).all()
+    write()
+    connection.execute(delete(staged_nine_hole_rounds))
+    if earliest:
+        scoring_record.replayFrom(earliest)
+    elif imported:
+        scoring_record.player.bump_version()    # Only 9 hole rounds waiting, still a change to the record.
+    db.session.commit()
+    snapshots.invalidate(player_id)
+    fragments.invalidate(player_id)
+    user_cache.invalidate(player_id)
+    return imported, errors
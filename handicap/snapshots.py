@@ -0,0 +1,51 @@
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+# The figures a page needs about a player's handicap, detached from the database session,
+# and the version of the player's data they were calculated from.
+Snapshot = namedtuple('Snapshot', ['handicap_index', 'low_handicap_index', 'low_handicap_index_date', 'counting_rounds', 'version'])
+# A counting round as displayed, in the (index in window, round, window size) 3-tuples of counting_rounds.
+CountingRound = namedtuple('CountingRound', ['id', 'played', 'course', 'gross_adjusted_score', 'score_differential'])
+
+class SnapshotCache():
+    """
+    A bounded, least recently used cache of handicap snapshots keyed by user id.
+
+    A snapshot only changes when a score is posted, updated or deleted, so the write paths
+    invalidate the player's entry and every other page view is served from the cache.
+    The cache lives in the worker process; each worker fills its own, and a snapshot is only
+    used while the player's version matches the one it was calculated from.
+    """
+
+    def __init__(self, app=None, maxsize: int=1024) -> None:
+        self.maxsize = maxsize
+        self._snapshots = OrderedDict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.maxsize = app.config.get('SNAPSHOT_CACHE_SIZE', self.maxsize)
+        self.clear()
+
+    def get(self, user_id: int) -> Snapshot | None:
+        with self._lock:
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is not None:
+                self._snapshots.move_to_end(user_id)    # Most recently used.
+            return snapshot
+
+    def put(self, user_id: int, snapshot: Snapshot) -> None:
+        with self._lock:
+            self._snapshots[user_id] = snapshot
+            self._snapshots.move_to_end(user_id)
+            while len(self._snapshots) > self.maxsize:
+                self._snapshots.popitem(last=False)     # Evict the least recently used.
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._snapshots.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._snapshots.clear()
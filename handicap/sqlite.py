@@ -0,0 +1,61 @@
+from flask import has_request_context, request
+from sqlalchemy import event
+
+def configure_sqlite(engine, pragmas: dict, immediate_writes: bool=False) -> None:
+    """
+    Set up a SQLite engine's connections for production.
+
+    Parameters:
+    engine: the SQLAlchemy engine.
+    pragmas (dict): PRAGMA settings applied to each new connection (e.g. journal_mode = WAL).
+    immediate_writes (bool): begin the transactions of requests that may write (anything but GET, HEAD
+    and OPTIONS, or work outside a request) with BEGIN IMMEDIATE. In WAL mode readers never wait,
+    but a transaction that reads and then writes fails at once with "database is locked" if another
+    write was committed in between. Taking the write lock up front makes it wait on busy_timeout instead.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        if immediate_writes:
+            dbapi_connection.isolation_level = None     # SQLAlchemy begins the transactions, not the driver.
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    if immediate_writes:
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            reading = has_request_context() and request.method in ('GET', 'HEAD', 'OPTIONS')
+            connection.exec_driver_sql('BEGIN' if reading else 'BEGIN IMMEDIATE')
+
+def is_locked(error) -> bool:
+    """
+    Return True if a database error is SQLite's "database is locked": another connection held the write lock
+    past busy_timeout, or committed between this transaction's read and its write (which fails at once,
+    as waiting can't help). The transaction can be rolled back and tried again.
+    """
+    return 'database is locked' in str(getattr(error, 'orig', error))
+
+def maintain(engine, checkpoint: str='TRUNCATE', optimize: bool=True) -> dict:
+    """
+    Checkpoint the write-ahead log into the database file and refresh the query planner's statistics.
+
+    Parameters:
+    engine: the SQLAlchemy engine.
+    checkpoint (str): the wal_checkpoint mode: PASSIVE, FULL, RESTART or TRUNCATE (which also empties the log).
+    optimize (bool): run PRAGMA optimize.
+
+    Returns:
+    A dict of the checkpoint's busy flag, and the pages in the log and checkpointed.
+    """
+    # On the driver's connection, as a checkpoint can't run inside the transaction SQLAlchemy would begin.
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        busy, log_pages, checkpointed_pages = cursor.execute(f'PRAGMA wal_checkpoint({checkpoint})').fetchone()
+        if optimize:
+            cursor.execute('PRAGMA optimize')
+        cursor.close()
+    finally:
+        connection.close()
+    return dict(busy=busy, log_pages=log_pages, checkpointed_pages=checkpointed_pages)
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class UserCache():
+    """
+    A bounded, least recently used cache of users' column values keyed by user id, each kept for a short time.
+
+    Flask-Login loads the user on every request; a cached user is rebuilt from its column values, after
+    reading only its version. The views that change a user, and the write paths that bump a player's version,
+    invalidate the player's entry; other worker processes see the bumped version and load the user again.
+    """
+
+    def __init__(self, app=None, maxsize: int=1024, ttl: float=30) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.maxsize = app.config.get('USER_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get(self, user_id: int) -> dict | None:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            expires, columns = entry
+            if monotonic() >= expires:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)    # Most recently used.
+            return columns
+
+    def put(self, user_id: int, columns: dict) -> None:
+        with self._lock:
+            self._users[user_id] = (monotonic() + self.ttl, columns)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.maxsize:
+                self._users.popitem(last=False)     # Evict the least recently used.
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
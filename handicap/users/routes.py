@@ -1,15 +1,17 @@
 from datetime import date
 from flask import Blueprint
-from flask import render_template, url_for, redirect, flash, request
+import os
+from flask import render_template, url_for, redirect, flash, request, send_from_directory, current_app
 from flask_login import login_user, logout_user, current_user, login_required
-from handicap import db, bcrypt
+from sqlalchemy.orm.exc import StaleDataError
+from handicap import db, bcrypt, user_cache, fragments
 from handicap.users.forms import (RegistrationForm, LoginForm, AccountForm,
                                   RequestResetForm, ResetPasswordForm)
 from handicap.models import User
-from handicap.handicap import ScoringRecord
-from handicap.users.utils import save_picture
+from handicap.users.utils import save_picture, profile_picture_url, PICTURE_DIRECTORY
 
 users = Blueprint('users', __name__)
+users.add_app_template_global(profile_picture_url)
 
 @users.route('/register', methods=['GET', 'POST'])
 def register():
@@ -53,20 +55,36 @@ def logout():
 def account():
     form = AccountForm()
     if form.validate_on_submit():
-        if form.picture.data:
-            picture_file = save_picture(form.picture.data)
-            current_user.image_file = picture_file
         current_user.name = form.name.data
         current_user.email = form.email.data
-        db.session.commit()
+        current_user.bump_version()     # The player's pages show the name.
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # Another change to the player's data was committed first.
+            db.session.rollback()
+            flash('Your account could not be updated, please try again.', 'danger')
+            return redirect(url_for('users.account'))
+        user_cache.invalidate(current_user.id)
+        fragments.invalidate(current_user.id)   # The header shows the name.
+        # After the commit: storing the picture bumps the version again.
+        if form.picture.data and not save_picture(form.picture.data, current_user.id):
+            flash('Your new picture will appear shortly.', 'info')
         flash('Your account has been updated.', 'success')
         return redirect(url_for('users.account'))
     elif request.method == 'GET':
         form.name.data = current_user.name
         form.email.data = current_user.email
-    current_user.handicap_index = ScoringRecord(current_user.id).handicapIndex()
-    image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
-    return render_template('account.html', title='Account', player=current_user.name, hi=current_user.handicap_index, image_file=image_file, form=form)
+    image_file = profile_picture_url(current_user.image_file)
+    return render_template('account.html', title='Account', image_file=image_file, form=form)
+
+@users.route('/profile_pics/<filename>')
+def profile_picture(filename):
+    # Resized pictures are named by their content, so they can be cached for good.
+    response = send_from_directory(os.path.join(current_app.root_path, PICTURE_DIRECTORY), filename,
+                                   max_age=365 * 24 * 60 * 60)
+    response.cache_control.immutable = True
+    return response
 
 @users.route('/reset_password', methods=['GET', 'POST'])
 def reset_request():
@@ -75,9 +93,10 @@ def reset_request():
     form = RequestResetForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data.lower()).first()
-        if user:
-            user.send_reset_email()
+        if user and user.send_reset_email():
             flash('An email has been sent with instructions to reset your password.', 'info')
+        elif user:
+            flash('The password reset email could not be sent just now. Please try again shortly.', 'warning')
         else:
             flash('A password reset email could not be sent to the address given.', 'warning')
         return redirect(url_for('users.login'))
@@ -96,6 +115,7 @@ def reset_token(token):
         hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
         user.password = hashed_password
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash('Your password has been updated! You are now able to log in.', 'success')
         return redirect(url_for('users.login'))
     return render_template('reset_token.html', title='Reset Password', form=form)
\ No newline at end of file
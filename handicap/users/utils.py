@@ -1,17 +1,108 @@
+import hashlib
+import io
 import os
-import secrets
-from flask import current_app as app
-from PIL import Image
-
-def save_picture(form_picture):
-    filename_hex = secrets.token_hex(8)
-    _, file_ext = os.path.splitext(form_picture.filename)
-    hex_filename = filename_hex + file_ext
-    full_hex_filename = os.path.join(app.root_path, 'static/profile_pics', hex_filename)
-
-    image_size = (125, 125)
-    image = Image.open(form_picture)
-    image.thumbnail(image_size)
-    image.save(full_hex_filename)
-
-    return hex_filename
\ No newline at end of file
+from threading import Lock
+from flask import url_for, current_app as app
+from sqlalchemy import func, select, update
+from handicap import db, user_cache, fragments
+from handicap.models import User
+
+PICTURE_SIZES = (64, 125, 250)  # Square bounds of the sizes stored, in pixels; 125 is shown, 250 for high density screens.
+PICTURE_DIRECTORY = 'static/profile_pics'
+
+_pool = None
+_pool_lock = Lock()
+
+def picture_pool():
+    """Return the process pool (a ProcessPoolExecutor) that resizes pictures, starting it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # Spawned rather than forked, as the web worker may be running threads.
+            _pool = ProcessPoolExecutor(max_workers=app.config.get('PICTURE_WORKERS', 1),
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+def process_picture(data: bytes, directory: str, name: str, sizes: tuple=PICTURE_SIZES) -> str:
+    """
+    Write an uploaded picture as WebP files of each size, named <name>-<size>.webp. Runs in a worker process.
+
+    Each file is written under a temporary name and then renamed, so a file is never seen half written.
+    Pillow is imported here rather than with the module, so only the processes that resize pictures load it.
+    """
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (max(sizes) * 2, max(sizes) * 2))    # Decode a large JPEG at a reduced scale.
+    image = ImageOps.exif_transpose(image)  # Turn phone photos the right way up.
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    for size in sizes:
+        resized = image.copy()
+        resized.thumbnail((size, size))
+        path = os.path.join(directory, f'{name}-{size}.webp')
+        resized.save(path + '.tmp', 'WEBP', quality=80, method=4)
+        os.replace(path + '.tmp', path)
+    return name
+
+def picture_stored(directory: str, name: str) -> bool:
+    return all(os.path.exists(os.path.join(directory, f'{name}-{size}.webp')) for size in PICTURE_SIZES)
+
+def set_picture(user_id: int, name: str) -> None:
+    """Point a user at a stored picture, and delete the files of the one it replaces if nobody else uses them."""
+    old_name = db.session.scalar(select(User.image_file).where(User.id == user_id))
+    users = User.__table__
+    db.session.execute(update(users).where(users.c.id == user_id).values(image_file=name, version=users.c.version + 1))
+    db.session.commit()
+    user_cache.invalidate(user_id)
+    fragments.invalidate(user_id)   # The header shows the picture.
+    if old_name and old_name not in (name, User.__table__.c.image_file.default.arg) \
+            and not db.session.scalar(select(func.count()).select_from(User).where(User.image_file == old_name)):
+        directory = os.path.join(app.root_path, PICTURE_DIRECTORY)
+        superseded = [old_name] if '.' in old_name else [f'{old_name}-{size}.webp' for size in PICTURE_SIZES]
+        for filename in superseded:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+def save_picture(form_picture, user_id: int) -> bool:
+    """
+    Store an uploaded profile picture for a user, named by a hash of its content, so the same picture is stored once.
+
+    A picture already stored is set at once. Otherwise it is resized in the picture process pool,
+    and set when it's ready, so the request needn't wait (PICTURE_WORKERS = 0 resizes it in the request).
+
+    Returns:
+    True if the picture has been set, or False if it will be set once processed.
+    """
+    data = form_picture.read()
+    name = hashlib.sha256(data).hexdigest()[:16]    # Fits User.image_file.
+    directory = os.path.join(app.root_path, PICTURE_DIRECTORY)
+    if picture_stored(directory, name):
+        set_picture(user_id, name)
+        return True
+    if not app.config.get('PICTURE_WORKERS', 1):
+        process_picture(data, directory, name)
+        set_picture(user_id, name)
+        return True
+
+    flask_app = app._get_current_object()
+    def picture_processed(future):
+        # Runs on a pool thread once the worker has finished.
+        with flask_app.app_context():
+            try:
+                set_picture(user_id, future.result())
+            except Exception:
+                flask_app.logger.exception(f'The profile picture for user {user_id} could not be processed.')
+            finally:
+                db.session.remove()
+    picture_pool().submit(process_picture, data, directory, name).add_done_callback(picture_processed)
+    return False
+
+def profile_picture_url(image_file: str, size: int=125) -> str:
+    """Return the URL of a user's picture at a size. Pictures saved before they were resized have one size only."""
+    if '.' in image_file:
+        return url_for('static', filename='profile_pics/' + image_file)
+    return url_for('users.profile_picture', filename=f'{image_file}-{size}.webp')